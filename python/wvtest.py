@@ -10,7 +10,9 @@ import atexit
 import inspect
 import os
 import re
+import struct
 import sys
+import time
 import traceback
 
 # NOTE
@@ -34,6 +36,53 @@ if __name__ != '__main__':   # we're imported as a module
     _tests = 0
     _fails = 0
 
+    # With WVTEST_BINARY=1 in the environment, the results are written in
+    # the binary framing of the protocol understood by wvtool (see
+    # WvFrameDecoder there) instead of text. Everything else written to
+    # sys.stdout or sys.stderr is framed as raw output of the test, so
+    # that it cannot be mistaken for results. Output written directly to
+    # file descriptors (e.g. by child processes) is not framed and
+    # breaks the stream.
+    _binary = os.environ.get('WVTEST_BINARY') == '1'
+
+    if _binary:
+        _out = sys.stdout
+
+        def _frame(kind, payload):
+            _out.write(struct.pack('<cI', kind, len(payload)) + payload)
+
+        class _FramedOutput(object):
+            def __init__(self, f):
+                self._f = f
+
+            def write(self, s):
+                if isinstance(s, unicode):
+                    s = s.encode('utf-8')
+                if s:
+                    _frame('O', s)
+
+            def writelines(self, lines):
+                for line in lines:
+                    self.write(line)
+
+            def flush(self):
+                _out.flush()
+
+            def __getattr__(self, name):
+                return getattr(self._f, name)
+
+        _out.write('\xffWvTest\x01\n')
+        sys.stdout = _FramedOutput(sys.stdout)
+        sys.stderr = _FramedOutput(sys.stderr)
+
+    def _testing(name, where):
+        if _binary:
+            _frame('S', struct.pack('<d', time.time()))
+            _frame('T', struct.pack('<I', len(name)) + name + where)
+        else:
+            print 'Testing "%s" in %s:' % (name, where)
+        sys.stdout.flush()
+
     def wvtest(func, innerfunc=None):
         """ Use this decorator (@wvtest) in front of any function you want to
             run as part of the unit test suite.  Then run:
@@ -53,8 +102,14 @@ if __name__ != '__main__':   # we're imported as a module
         filename = os.path.basename(filename)
         msg = re.sub(r'\s+', ' ', str(msg))
         sys.stderr.flush()
-        print '! %-70s %s' % ('%s:%-4d %s' % (filename, line, msg),
-                              code)
+        if _binary:
+            # Time of the check for durations of JUnit testcases
+            _frame('S', struct.pack('<d', time.time()))
+            _frame('C', chr(len(code)) + code +
+                   ('%s:%-4d %s' % (filename, line, msg)).rstrip())
+        else:
+            print '! %-70s %s' % ('%s:%-4d %s' % (filename, line, msg),
+                                  code)
         sys.stdout.flush()
 
 
@@ -205,8 +260,7 @@ def _runtest(fname, f, innerfunc):
     mod = inspect.getmodule(innerfunc)
     relpath = os.path.relpath(mod.__file__, os.getcwd()).replace('.pyc', '.py')
     print
-    print 'Testing "%s" in %s:' % (fname, relpath)
-    sys.stdout.flush()
+    _wvtestmod._testing(fname, relpath)
     try:
         _run_in_chdir(os.path.split(mod.__file__)[0], f)
     except Exception, e:
@@ -0,0 +1,708 @@
+#!/usr/bin/env python3
+#
+# WvTest:
+#   Copyright (C) 2017 Michal Sojka <sojkam1@fel.cvut.cz>
+#       Licensed under the GNU Library General Public License, version 2.
+#       See the included file named LICENSE for license information.
+#
+# Micro-benchmarks of wvtool internals. Run as:
+#   tools/wvbench.py [-n LINES] [benchmark...]
+# Without arguments, all benchmarks are run. Every benchmark also
+# checks that the optimized code gives the same results as the
+# straightforward implementation.
+
+import argparse
+import datetime
+import inspect
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import wvtool
+import wvjunit
+from xml.sax.saxutils import escape, quoteattr
+
+nul_prefix = r'\([0-9]+\) (?:#   )?'
+
+def synthetic_log(n, prefix='', seed=0):
+    """Return a list of n lines resembling the output of a typical test
+    binary - mostly plain output with some checks and sections."""
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(n):
+        r = rnd.random()
+        if r < 0.001:
+            lines.append(prefix + 'Testing "test {}" in t/test{}.t.cc:'.format(i, i % 7))
+        elif r < 0.08:
+            lines.append(prefix + '! t/test.t.cc:{}  a == {}  {}'.format(
+                i, i, 'ok' if rnd.random() < 0.99 else 'FAILED'))
+        elif r < 0.081:
+            lines.append(prefix + 'wvtest: timeout {}'.format(i % 100))
+        elif r < 0.09:
+            # Plain lines that look almost like protocol lines
+            lines.append(prefix + 'Warning! value {} out of range'.format(i))
+        else:
+            lines.append(prefix + 'some output of the test program, counter = {}'.format(i))
+    return lines
+
+def report(name, count, unit, seconds):
+    print('{:<40} {:>12.0f} {}/s ({:.3f} s)'.format(name, count / seconds, unit, seconds))
+
+class LegacyLine:
+    """WvLine as it was implemented before the introduction of
+    __slots__ and lazy decoding."""
+    def __init__(self, match):
+        for (key, val) in match.groupdict().items():
+            setattr(self, key, val)
+
+class LegacyCheckLine(LegacyLine):
+    fields = wvtool.WvCheckLine.fields
+    re_body = wvtool.WvCheckLine.re_body
+
+class LegacyTestingLine(LegacyLine):
+    fields = wvtool.WvTestingLine.fields
+    re_body = wvtool.WvTestingLine.re_body
+
+class LegacyTagLine(LegacyLine):
+    fields = wvtool.WvTagLine.fields
+    re_body = wvtool.WvTagLine.re_body
+
+class LegacyPlainLine(LegacyLine):
+    fields = wvtool.WvPlainLine.fields
+    re = re.compile("(?P<line>.*)")
+
+legacy_classes = {
+    LegacyCheckLine: wvtool.WvCheckLine,
+    LegacyTestingLine: wvtool.WvTestingLine,
+    LegacyTagLine: wvtool.WvTagLine,
+    LegacyPlainLine: wvtool.WvPlainLine,
+}
+
+def legacy_classify(prefix):
+    """Classification as done by processLine before the introduction of
+    WvLineClassifier - the regexes are tried one by one."""
+    classes = []
+    for cls in (LegacyCheckLine, LegacyTestingLine, LegacyTagLine):
+        classes.append((cls, re.compile('(?P<prefix>' + prefix + ')' + cls.re_body)))
+    classes.append((LegacyPlainLine, LegacyPlainLine.re))
+
+    def classify(line):
+        for (lineClass, regex) in classes:
+            match = regex.match(line)
+            if match:
+                return lineClass(match)
+    return classify
+
+class LegacyJUnitBase:
+    """wvjunit.JUnitBase as it was implemented before the schema caching
+    and single-pass escaping."""
+    def _get_valid_members(self):
+        return [x for x in dir(self.__class__)
+                if not x.startswith('_') and
+                   not inspect.isfunction(getattr(self.__class__, x))]
+
+    def __init__(self, **kwargs):
+        valid_members = self._get_valid_members()
+        for (key, val) in kwargs.items():
+            if isinstance(val, getattr(self.__class__, key)) or val == None:
+                setattr(self, key, val)
+            else:
+                setattr(self, key, getattr(self.__class__, key)(val))
+        for key in valid_members:
+            if key not in kwargs:
+                setattr(self, key, getattr(self.__class__, key)())
+
+    def escaped_values(self):
+        class EscapedObject(object): pass
+        ret = EscapedObject()
+        for attr in self._get_valid_members():
+            if type(getattr(self, attr)) not in [float]:
+                setattr(ret, attr, escape(str(getattr(self, attr)), wvjunit.escEntities))
+                setattr(ret, attr+"_attr", quoteattr(str(getattr(self, attr)), wvjunit.escEntities))
+            else:
+                setattr(ret, attr, getattr(self, attr))
+        return ret
+
+    def print(self, file=sys.stdout):
+        if str(self):
+            print(str(self), file=file)
+
+class LegacyFailure(LegacyJUnitBase):
+    message = str
+    type = str
+    text = str
+
+    def __str__(self):
+        return ('<failure type={self.type_attr} message={self.message_attr}>'
+                '{self.text}</failure>'.format(self=self.escaped_values()))
+
+class LegacySystemOut(LegacyJUnitBase):
+    text = str
+
+    def __str__(self):
+        if self.text:
+            return '<system-out>{self.text}</system-out>'.format(self=self.escaped_values())
+        else:
+            return ''
+
+class LegacyTestcase(LegacyJUnitBase):
+    classname = str
+    name = str
+    time = float
+    system_out = LegacySystemOut
+    failure = LegacyFailure
+
+    def print(self, file=sys.stdout):
+        print(('<testcase classname={self.classname_attr} name={self.name_attr}'
+               ' time="{self.time:.3f}">').format(self=self.escaped_values()), file=file)
+        if self.failure:
+            self.failure.print(file)
+        if self.system_out:
+            self.system_out.print(file)
+        print("</testcase>", file=file)
+
+class LegacyTestsuite(LegacyJUnitBase):
+    errors = int
+    failures = int
+    hostname = str
+    name = str
+    tests = int
+    time = float
+    timestamp = datetime.datetime
+    properties = list
+    testcases = list
+    system_out = LegacySystemOut
+    system_err = str
+
+    def print(self, file = sys.stdout):
+        ts = self.timestamp.replace(microsecond=0)
+        print('<testsuite tests="{self.tests}" errors="{self.errors}" failures="{self.failures}" hostname={self.hostname_attr} name={self.name_attr} time="{self.time:.3f}" timestamp="{timestamp}">'.format(self=self.escaped_values(), timestamp=ts.isoformat()),
+              file = file)
+        print("<properties>", file=file)
+        for p in self.properties:
+            p.print(file=file)
+        print("</properties>", file=file)
+        for t in self.testcases:
+            t.print(file=file)
+        self.system_out.print(file=file)
+        print("</testsuite>", file=file)
+
+def bench_classify(args):
+    "Lines/second of WvLineClassifier compared to sequential regex matching"
+    for (label, prefix, line_prefix) in (('no prefix', '', ''),
+                                         ('NUL prefix', nul_prefix, '(1) ')):
+        lines = synthetic_log(args.lines, line_prefix)
+        raw_lines = [l.encode() for l in lines]
+        legacy = legacy_classify(prefix)
+        classifier = wvtool.WvLineClassifier(prefix)
+
+        t = time.perf_counter()
+        expected = [legacy(l) for l in lines]
+        report('sequential regexes, ' + label, len(lines), 'lines', time.perf_counter() - t)
+
+        t = time.perf_counter()
+        result = [classifier.classify(l) for l in raw_lines]
+        report('WvLineClassifier, ' + label, len(lines), 'lines', time.perf_counter() - t)
+
+        for (e, r) in zip(expected, result):
+            if legacy_classes[type(e)] != type(r) or \
+               any(getattr(e, f) != getattr(r, f) for f in e.fields):
+                sys.exit('Classification mismatch: {!r} vs. {!r}'.format(vars(e), r.raw))
+
+def bench_lines(args):
+    "Memory usage and throughput of WvLine objects compared to legacy ones"
+    lines = synthetic_log(args.lines)
+    raw_lines = [l.encode() for l in lines]
+    legacy = legacy_classify('')
+    classifier = wvtool.WvLineClassifier()
+
+    def count(entries):
+        # What WvTestProcessor does in the summary mode
+        checks = failures = 0
+        for e in entries:
+            if type(e) == LegacyCheckLine:
+                checks += 1
+                failures += e.result != 'ok'
+            elif type(e) == wvtool.WvCheckLine:
+                checks += 1
+                failures += not e.is_success()
+        return (checks, failures)
+
+    # Legacy lines are classified from decoded text, as they were
+    t = time.perf_counter()
+    expected = count(legacy(l.decode(wvtool.encoding, 'replace')) for l in raw_lines)
+    report('legacy lines, count', len(lines), 'lines', time.perf_counter() - t)
+
+    t = time.perf_counter()
+    result = count(classifier.classify(l) for l in raw_lines)
+    report('WvLine, count', len(lines), 'lines', time.perf_counter() - t)
+    if result != expected:
+        sys.exit('Count mismatch: {} vs. {}'.format(expected, result))
+
+    # Lines split from chunks of a pipe are the same as when the whole
+    # output is split (as text files with universal newlines were)
+    rnd = random.Random(0)
+    data = b'\r\n'.join(raw_lines[:1000]) + b'\r\r\n\n\r'
+    cuts = sorted(rnd.sample(range(len(data)), 300))
+    for chunks in ([b'a\r', b'\n', b'\nb\n'], [b'a\r', b'', b'\nb\r', b'\r\n'],
+                   [data[i:j] for (i, j) in zip([0] + cuts, cuts + [len(data)])]):
+        splitter = wvtool.WvLineSplitter()
+        result = [line for chunk in chunks for line in splitter.feed(chunk)] + splitter.flush()
+        if result != b''.join(chunks).splitlines():
+            sys.exit('Line splitting mismatch for {!r}'.format(chunks[:3]))
+
+    for (name, make) in (('legacy lines', lambda: [legacy(l.decode()) for l in raw_lines]),
+                         ('WvLine', lambda: [classifier.classify(l) for l in raw_lines])):
+        tracemalloc.start()
+        entries = make()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del entries
+        # WvLine objects retain the input lines (allocated above)
+        if name == 'WvLine':
+            size += sum(sys.getsizeof(l) for l in raw_lines)
+        print('{:<40} {:>12.0f} bytes/line ({:.0f} MiB per 10M lines)'.format(
+            name + ', retained', size / len(lines), size / len(lines) * 10**7 / 2**20))
+
+def bench_junit(args):
+    "JUnit XML serialization compared to the legacy wvjunit"
+    # Testcases are created by WvTestProcessor for every check, so one
+    # suite per section with lines/10 checks in total
+    rnd = random.Random(0)
+    sections = []
+    for s in range(max(1, args.lines // 1000)):
+        checks = []
+        for c in range(100):
+            text = 't/test.t.cc:{}  a[{}] < b && c > "{}"'.format(c, s, rnd.random())
+            if c == 7:
+                text += ' \x01\x00 control'
+            checks.append((text, rnd.random() < 0.99))
+        output = ['output line {} of section {} & <more>'.format(l, s) for l in range(10)]
+        sections.append(('test_{}.section {}'.format(s, s), checks, output))
+    timestamp = datetime.datetime(2017, 1, 1)
+
+    def serialize(junit, system_out):
+        f = io.StringIO()
+        for (name, checks, output) in sections:
+            testcases = [junit.Testcase(
+                classname=name, name=text, time=0.001,
+                failure=None if ok else junit.Failure(type='WvTest check', message=text))
+                         for (text, ok) in checks]
+            junit.Testsuite(tests=len(checks), failures=0, errors=0, name=name,
+                            time=1.5, hostname='host.example.com', timestamp=timestamp,
+                            testcases=testcases, system_out=system_out(output)).print(f)
+        return f.getvalue()
+
+    class legacy:
+        Testcase = LegacyTestcase
+        Failure = LegacyFailure
+        Testsuite = LegacyTestsuite
+
+    testcases = sum(len(checks) for (name, checks, output) in sections)
+    t = time.perf_counter()
+    expected = serialize(legacy, lambda output: LegacySystemOut(text='\n'.join(output) + '\n'))
+    report('legacy wvjunit', testcases, 'testcases', time.perf_counter() - t)
+
+    t = time.perf_counter()
+    result = serialize(wvjunit, wvjunit.SystemOutStream)
+    report('wvjunit', testcases, 'testcases', time.perf_counter() - t)
+    if result != expected:
+        sys.exit('JUnit XML mismatch')
+
+def encode_frames(lines, prefix=''):
+    """Encode a synthetic log (without prefix) to the binary framing
+    (see wvtool.WvFrameDecoder)."""
+    classifier = wvtool.WvLineClassifier(prefix)
+    header = wvtool.WvFrameDecoder.header
+    frames = [wvtool.WvFrameDecoder.magic]
+    for line in lines:
+        entry = classifier.classify(line.encode())
+        if type(entry) == wvtool.WvTestingLine:
+            what = entry.what.encode()
+            payload = len(what).to_bytes(4, 'little') + what + entry.where.encode()
+            frames.append(header.pack(ord('T'), len(payload)) + payload)
+        elif type(entry) == wvtool.WvCheckLine:
+            result = entry.result.encode()
+            payload = bytes([len(result)]) + result + entry.text.encode()
+            frames.append(header.pack(ord('C'), len(payload)) + payload)
+        elif type(entry) == wvtool.WvTagLine:
+            payload = entry.tag.encode()
+            frames.append(header.pack(ord('G'), len(payload)) + payload)
+        else:
+            payload = line.encode() + b'\n'
+            frames.append(header.pack(ord('O'), len(payload)) + payload)
+    return b''.join(frames)
+
+def bench_framing(args):
+    "Processing of the binary protocol compared to the text protocol"
+    log = synthetic_log(args.lines)
+    chunk = 256 * 1024
+
+    wvtool.term = wvtool.Term(80)
+    wvtool.term.clear_colors()
+    Verbosity = wvtool.WvTestProcessor.Verbosity
+    # Typical output and output of tests printing only results
+    for (label, verbosity, lines) in (
+            ('summary', Verbosity.SUMMARY, log),
+            ('normal', Verbosity.NORMAL, log),
+            ('checks only, summary', Verbosity.SUMMARY, [l for l in log if l[0] in '!T']),
+            ('checks only, normal', Verbosity.NORMAL, [l for l in log if l[0] in '!T'])):
+        text = ''.join(l + '\n' for l in lines).encode()
+        binary = encode_frames(lines)
+        results = []
+        for (name, data) in (('text', text), ('binary', binary)):
+            processor = wvtool.WvTestProcessor(verbosity, output=io.StringIO())
+            input = wvtool.WvInputDecoder(processor)
+            t = time.perf_counter()
+            for i in range(0, len(data), chunk):
+                input.feed(data[i:i+chunk])
+            input.flush()
+            processor.done()
+            report('{} protocol, {}'.format(name, label), len(lines), 'lines',
+                   time.perf_counter() - t)
+            results.append(processor.output.getvalue())
+        if results[0] != results[1]:
+            sys.exit('Output mismatch')
+        print('{:<40} {:>12.1f} bytes/line (text {:.1f})'.format(
+            'binary protocol size', len(binary) / len(lines), len(text) / len(lines)))
+
+def bench_scan(args):
+    "Summary of log files scanned with mmap compared to reading them line by line"
+    log = synthetic_log(args.lines)
+    # Long runs of plain output with a check now and then
+    sparse = [l if l[0] not in '!Tw' or i % 50 == 0 else 'some output of the test program'
+              for (i, l) in enumerate(log)]
+
+    wvtool.term = wvtool.Term(80)
+    wvtool.term.clear_colors()
+    Verbosity = wvtool.WvTestProcessor.Verbosity
+    for (label, lines) in (('typical log', log), ('sparse log', sparse)):
+        with tempfile.TemporaryFile() as f:
+            f.write(''.join(l + '\n' for l in lines).encode())
+            size = f.tell()
+            results = []
+            for (name, process) in (('read', wvtool._processFile), ('mmap', wvtool._scanFile)):
+                f.seek(0)
+                processor = wvtool.WvTestProcessor(Verbosity.SUMMARY, output=io.StringIO())
+                t = time.perf_counter()
+                process(f, processor)
+                processor.done()
+                report('{}, {}'.format(name, label), size / 2**20, 'MiB', time.perf_counter() - t)
+                results.append(processor.output.getvalue())
+            if results[0] != results[1]:
+                sys.exit('Output mismatch')
+
+def perf_history(lines, days=5*365, seed=0):
+    """Return nightly logs of a synthetic history (5 years by default)
+    of performance measurements with about the given number of PERF
+    results, as wvperf2html.py gets them."""
+    rnd = random.Random(seed)
+    columns = 10
+    graphs = max(1, lines // (days * columns))
+    start = datetime.datetime(2015, 1, 1, 3, 0, 0)
+    log = []
+    for day in range(days):
+        date = start + datetime.timedelta(days=day, seconds=rnd.randrange(3600))
+        log.append(date.strftime('Date: %a, %d %b %Y %H:%M:%S +0200'))
+        commit = '{:07x} (Commit message of day {})'.format(rnd.randrange(16**7), day)
+        for g in range(graphs):
+            log.append('Testing "{} benchmark, {}, commit: {}" in tests/bench{}.c:'.format(
+                'all' if g % 2 else 'Graph {}'.format(g), date.strftime('%Y-%m-%d %H:%M:%S'),
+                commit, g))
+            log.append('Some output of the benchmark')
+            for c in range(columns):
+                value = 100 * (c + 1) * (1 + 0.1 * (day > days // 2)) * rnd.uniform(0.98, 1.02)
+                result = 'ok' if rnd.random() < 0.995 else 'FAILED'
+                axis = ' axis="latency"' if c % 3 == 0 else ''
+                log.append('! tests/bench{}.c:{}  PERF: metric{} {:.3f} {}{}  {}'.format(
+                    g, c, c, value, 'MB/s' if c % 2 else 'ms', axis, result))
+    return log
+
+class LegacyAxis:
+    def __init__(self, name=None, units=None):
+        self.name = name
+        self.units = units
+        self.num = None
+
+class LegacyColumn:
+    def __init__(self, name, units, axis):
+        self.name = name
+        self.units = units
+        self.axis = axis
+
+class LegacyRow(dict):
+    def __init__(self, graph, date):
+        self.graph = graph
+        self.date = date
+    def __getitem__(self, column):
+        try:
+            return dict.__getitem__(self, column)
+        except KeyError:
+            return None
+
+class LegacyGraph:
+    "Graph of wvperf2html.py before it used columnar NumPy storage"
+    def __init__(self, id, title):
+        self.columns = {}
+        self.columns_ordered = []
+        self.id = id
+        self.title = title
+        self.rows = []
+        self.date2row = {}
+        self.axes = {}
+
+    def __getitem__(self, date):
+        try:
+            rownum = self.date2row[date]
+        except KeyError:
+            rownum = len(self.rows)
+            self.date2row[date] = rownum
+        try:
+            return self.rows[rownum]
+        except IndexError:
+            self.rows[rownum:rownum] = [LegacyRow(self, date)]
+            return self.rows[rownum]
+
+    def addValue(self, date, col, val, units):
+        row = self[date]
+        row[col] = val
+        if col not in self.columns:
+            axis=self.getAxis(units) or self.addAxis(units, LegacyAxis(units=units))
+            column = LegacyColumn(col, units, axis)
+            self.columns[col] = column
+            self.columns_ordered.append(column)
+        else:
+            column = self.columns[col]
+            self.columns_ordered.remove(column)
+            self.columns_ordered.append(column)
+        self.columns[col].units=units
+        self.columns[col].axis.units=units
+
+    def addAxis(self, key, axis):
+        self.axes[key] = axis
+        return axis
+
+    def setAxis(self, col, key):
+        self.columns[col].axis = self.getAxis(key) or self.addAxis(key, LegacyAxis(name=key))
+
+    def getAxis(self, key):
+        if key not in self.axes: return None
+        return self.axes[key]
+
+    def findRanges(self):
+        import numpy as np
+        for axis in self.axes.values():
+            cols = [col for col in self.columns.values() if col.axis == axis]
+            low = None
+            high = None
+            all_in_range = True
+            for col in cols:
+                values = np.array([row[col.name] for row in self.rows if row[col.name] != None], np.float64)
+                if low == None and high == None:
+                    lastmonth = values[-30:]
+                    median = np.median(lastmonth)
+                    low  = median * 0.95
+                    high = median * 1.05
+
+                if (values > high).any() or (values < low).any():
+                    all_in_range = False
+            if all_in_range:
+                axis.yrange_max = high
+                axis.yrange_min = low
+            else:
+                axis.yrange_max = None
+                axis.yrange_min = None
+
+def legacy_perf_parse(lines):
+    "Parser of wvperf2html.py before it was streaming"
+    m = wvperf2html
+    graphs = {}
+    date = time.localtime(time.time())
+    for line in lines:
+        line = line.rstrip()
+        match = m.re_date.match(line)
+        if (match):
+            date = time.strptime(match.group(1), "%a, %d %b %Y %H:%M:%S +0200")
+            continue
+        match = m.re_testing.match(line)
+        if match:
+            what = match.group(2)
+            where = match.group(3)
+            match = m.re_commit.match(what)
+            if match:
+                date = time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
+            (basename, ext) = os.path.splitext(os.path.basename(where))
+            if what != "all": title = what
+            else: title = basename
+            try:
+                graph = graphs[basename]
+            except KeyError:
+                graph = LegacyGraph(basename, title)
+                graphs[basename] = graph
+            continue
+        match = m.re_perf.match(line)
+        if match:
+            perfstr = match.group(3)
+            perf = perfstr.split()
+            col = perf[0]
+            try:
+                val = float(perf[1])
+            except ValueError:
+                val = None
+            try:
+                units = perf[2]
+                if '=' in units: units = None
+            except:
+                units = None
+            if match.group(4) != "ok":
+                val=None
+            graph.addValue(date, col, val, units)
+            match = m.re_perfaxis.search(perfstr)
+            if match:
+                graph.setAxis(col, match.group(1));
+    return graphs
+
+def bench_perf2html(args):
+    "Parsing and axis ranges of wvperf2html.py on a 5-year history compared to the legacy code"
+    global wvperf2html
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import wvperf2html
+    import numpy as np
+
+    text = ''.join(l + '\n' for l in perf_history(args.lines))
+    samples = text.count('PERF:')
+
+    t = time.perf_counter()
+    expected = legacy_perf_parse(io.StringIO(text).readlines())
+    for g in expected.values():
+        g.findRanges()
+    report('legacy wvperf2html', samples, 'samples', time.perf_counter() - t)
+
+    t = time.perf_counter()
+    graphs = {}
+    wvperf2html.parse(io.StringIO(text), graphs, {})
+    wvperf2html.prepare(graphs)
+    report('wvperf2html', samples, 'samples', time.perf_counter() - t)
+
+    for (name, e) in expected.items():
+        g = graphs[name]
+        if [c.name for c in e.columns_ordered] != [c.name for c in g.columns_ordered]:
+            sys.exit('Column order mismatch in ' + name)
+        if [time.mktime(r.date) for r in e.rows] != g.dates.tolist():
+            sys.exit('Date mismatch in ' + name)
+        for c in e.columns_ordered:
+            values = np.array([np.nan if r[c.name] is None else r[c.name] for r in e.rows])
+            if not np.array_equal(values, g.values[g.columns[c.name].index], equal_nan=True):
+                sys.exit('Value mismatch in {} {}'.format(name, c.name))
+        for (key, axis) in e.axes.items():
+            if (axis.yrange_min, axis.yrange_max) != (g.axes[key].yrange_min, g.axes[key].yrange_max):
+                sys.exit('Axis range mismatch in {} {}'.format(name, key))
+
+    # Nightly update: one new log added to a store with the history
+    # compared to parsing all logs again
+    logs = text.split('Date: ')[1:]
+    with tempfile.TemporaryDirectory() as path:
+        store = wvperf2html.Store(path)
+        for log in logs[:-1]:
+            store.ingest(('Date: ' + log).encode())
+        store.save()
+        t = time.perf_counter()
+        store = wvperf2html.Store(path)
+        store.ingest(('Date: ' + logs[-1]).encode())
+        store.save()
+        report('wvperf2html ingest of one log', 1, 'logs', time.perf_counter() - t)
+        t = time.perf_counter()
+        store = wvperf2html.Store(path)
+        output = io.StringIO()
+        wvperf2html.html(wvperf2html.prepare(store.load()), store.commits, output)
+        report('wvperf2html html from store', samples, 'samples', time.perf_counter() - t)
+    graphs = {}
+    commits = {}
+    wvperf2html.parse(io.StringIO(text), graphs, commits)
+    expected = io.StringIO()
+    graphs = wvperf2html.prepare(graphs)
+    wvperf2html.html(graphs, commits, expected)
+    if output.getvalue() != expected.getvalue():
+        sys.exit('HTML from store mismatch')
+
+    # Logs with CRLF line endings give the same results
+    with tempfile.TemporaryDirectory() as path:
+        store = wvperf2html.Store(path)
+        store.ingest(text.replace('\n', '\r\n').encode())
+        store.save()
+        store = wvperf2html.Store(path)
+        output = io.StringIO()
+        wvperf2html.html(wvperf2html.prepare(store.load()), store.commits, output)
+    if output.getvalue() != expected.getvalue():
+        sys.exit('HTML from store of CRLF log mismatch')
+
+    # Page with the chart data in separate, downsampled files
+    with tempfile.TemporaryDirectory() as path:
+        t = time.perf_counter()
+        wvperf2html.write(graphs, commits, path, 500)
+        report('wvperf2html html with data files', samples, 'samples', time.perf_counter() - t)
+        page = os.path.getsize(os.path.join(path, 'index.html'))
+        print('{:<40} {:>12.1f} KiB (inline {:.1f} KiB)'.format(
+            'page size', page / 1024, len(expected.getvalue()) / 1024))
+        print('{:<40} {:>12.1f} KiB'.format('overview data per graph', sum(
+            os.path.getsize(os.path.join(path, g.dataFile())) for g in graphs) / len(graphs) / 1024))
+        for g in graphs:
+            with open(os.path.join(path, g.dataFile('.full.json'))) as f:
+                full = json.load(f)
+            values = np.array(full['y'], np.float64)
+            if not np.array_equal(values, g.values, equal_nan=True):
+                sys.exit('Full data mismatch in ' + g.id)
+            with open(os.path.join(path, g.dataFile())) as f:
+                overview = json.load(f)
+            for (x, y, row) in zip(overview['x'], overview['y'], values):
+                if len(x) > 500 or x[0] != full['x'][0] or x[-1] != full['x'][-1]:
+                    sys.exit('Bad overview of ' + g.id)
+                if not np.array_equal(row[np.searchsorted(full['x'], x)], np.array(y, np.float64),
+                                      equal_nan=True):
+                    sys.exit('Overview mismatch in ' + g.id)
+
+    if wvperf2html.Graph('a/b', '').dataFile() == wvperf2html.Graph('a b', '').dataFile():
+        sys.exit('Data files of different graphs collide')
+
+    # Every series of the history has a single step in the middle
+    t = time.perf_counter()
+    for g in graphs:
+        g.findSteps(10, 5, 0.05)
+    report('wvperf2html step detection', sum(len(g.columns) for g in graphs), 'series',
+           time.perf_counter() - t)
+    for g in graphs:
+        # Failed samples can move the step by a date
+        middle = np.searchsorted(g.dates, wvperf2html.changes([g], commits)[0]['date'])
+        steps = sorted((col.name, abs(i - middle) <= 1) for (col, i, before, after) in g.steps)
+        if steps != sorted((name, True) for name in g.columns):
+            sys.exit('Steps mismatch in {}: {}'.format(g.id, steps))
+
+benchmarks = {
+    'classify': bench_classify,
+    'framing': bench_framing,
+    'junit': bench_junit,
+    'lines': bench_lines,
+    'perf2html': bench_perf2html,
+    'scan': bench_scan,
+}
+
+parser = argparse.ArgumentParser(description='Benchmark wvtool internals')
+parser.add_argument('-n', '--lines', type=int, default=1000000,
+                    help='Number of lines of synthetic logs (default %(default)s)')
+parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                    help='Benchmarks to run: {} (default all)'.format(', '.join(sorted(benchmarks))))
+args = parser.parse_args()
+for name in args.benchmarks:
+    if name not in benchmarks:
+        parser.error('unknown benchmark: ' + name)
+
+for name in args.benchmarks or sorted(benchmarks):
+    print('{}: {}'.format(name, benchmarks[name].__doc__))
+    benchmarks[name](args)
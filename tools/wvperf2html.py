@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # WvTest:
 #   Copyright (C) 2012 Michal Sojka <sojka@os.inf.tu-dresden.de>
@@ -9,29 +9,122 @@
 # results of performance measurements to interactive graphs (HTML +
 # JavaScript). An example can be seen at
 # http://os.inf.tu-dresden.de/~sojka/nul/performance.html.
+#
+# Input is parsed line by line as it is read. Samples are collected in
+# compact arrays and, once everything is read, every graph is converted
+# to a NumPy matrix of values (columns x dates), so that the memory
+# usage and the time of computing the axis ranges do not depend on the
+# number of Python objects per sample.
+#
+# Parsed results can be kept in a store, to which only new logs are
+# added every night:
+#
+#   ./wvperf2html.py ingest perf-store nul-nightly/nul_*.log
+#   ./wvperf2html.py html perf-store > graphs.html
+#
+# With -o DIR, the page is written to DIR/index.html and the data of
+# every graph to separate JSON files in DIR/data, which are loaded only
+# when the graph is scrolled into view. Long series are downsampled
+# (see lttb()) and all samples are loaded when a range with at most
+# --max-points samples is selected.
+#
+# Steps in performance are detected in every series (see
+# Graph.findSteps()), marked in the charts and the largest regressions
+# and improvements are listed at the top of the page. With --changes
+# FILE, all of them are also written to FILE as JSON.
 
 import sys
 import re
 import os
 import os.path
-import string
+import io
 import time
+import math
+import array
+import functools
+import argparse
+import hashlib
+import json
+import tempfile
+from xml.sax.saxutils import escape
 import numpy as np
-
-re_prefix = "\([0-9]+\) (?:#   )?"
-re_date = re.compile('^Date: (.*)')
-re_testing = re.compile('^('+re_prefix+')?\s*Testing "(.*)" in (.*):\s*$')
-re_commit = re.compile('.*(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}).*, commit: (.*)')
-re_commithash = re.compile('([0-9a-f]{7})(-dirty)? \(')
-re_assertion = re.compile('^('+re_prefix+')?!\s*(.*?)\s+(\S+)\s*$')
-re_perf =  re.compile('^('+re_prefix+')?!\s*(.*?)\s+PERF:\s*(.*?)\s+(\S+)\s*$')
-re_perfaxis = re.compile('axis="([^"]+)"')
+from numpy.lib.stride_tricks import sliding_window_view
+
+re_prefix = r"\([0-9]+\) (?:#   )?"
+re_date = re.compile(r'^Date: (.*)')
+re_testing = re.compile(r'^('+re_prefix+r')?\s*Testing "(.*)" in (.*):\s*$')
+re_commit = re.compile(r'.*(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}).*, commit: (.*)')
+re_commithash = re.compile(r'([0-9a-f]{7})(-dirty)? \(')
+re_assertion = re.compile(r'^('+re_prefix+r')?!\s*(.*?)\s+(\S+)\s*$')
+re_perf =  re.compile(r'^('+re_prefix+r')?!\s*(.*?)\s+PERF:\s*(.*?)\s+(\S+)\s*$')
+re_perfaxis = re.compile(r'axis="([^"]+)"')
+
+@functools.lru_cache(maxsize=4096)
+def parseDate(text, format):
+    """Return seconds since the epoch of the local time in text. Dates
+    repeat a lot (every section of a log has the same commit date), so
+    the results are cached."""
+    return time.mktime(time.strptime(text, format))
+
+def jsDate(date):
+    d = time.gmtime(date)
+    return "Date.UTC(%s, %s, %s, %s, %s, %s)" % \
+        (d.tm_year, d.tm_mon-1, d.tm_mday, d.tm_hour, d.tm_min, d.tm_sec)
+
+# Number of regressions and improvements listed at the top of the page
+summary_size = 10
+
+def jsonValues(values):
+    "Convert an array of values to a list for JSON (None if missing)."
+    return [None if v != v else v for v in values.tolist()]
+
+def lttb(x, values, points):
+    """Downsample rows of values (NaN if missing) at x to the given
+    number of points with the Largest-Triangle-Three-Buckets algorithm
+    (S. Steinarsson, 2013). The first and the last samples are kept and
+    the others are split to buckets, each represented by the sample
+    forming the largest triangle with the sample selected from the
+    previous bucket and the average of the next bucket. Buckets are the
+    same for all rows, so that all rows are processed at once. Missing
+    values are selected only from buckets without any other sample.
+    At least 3 points are needed (a bucket besides the end samples).
+    Return the indices of the selected samples (rows x points)."""
+    (rows, n) = values.shape
+    if n <= points:
+        return np.tile(np.arange(n), (rows, 1))
+    # Bucket i is edges[i]:edges[i+1], the last one ends before n-1
+    edges = (np.arange(points - 1) * ((n - 2) / (points - 2))).astype(np.intp) + 1
+    valid = ~np.isnan(values)
+    # Averages of the next buckets (the last sample follows the last bucket)
+    counts = np.add.reduceat(valid, edges[1:], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avgy = np.add.reduceat(np.where(valid, values, 0), edges[1:], axis=1) / counts
+    avgx = np.add.reduceat(x, edges[1:]) / np.diff(edges[1:], append=n)
+
+    selected = np.empty((rows, points), np.intp)
+    selected[:, 0] = 0
+    selected[:, -1] = n - 1
+    r = np.arange(rows)
+    a = np.zeros(rows, np.intp)
+    for i in range(points - 2):
+        (start, end) = (edges[i], edges[i+1])
+        (xa, ya) = (x[a][:, None], values[r, a][:, None])
+        area = np.abs((xa - avgx[i]) * (values[:, start:end] - ya)
+                      - (xa - x[start:end]) * (avgy[:, i, None] - ya))
+        # Prefer valid samples, even if the area is unknown
+        area = np.where(valid[:, start:end], np.nan_to_num(area, nan=0), -1)
+        chosen = start + np.argmax(area, axis=1)
+        selected[:, i+1] = chosen
+        a = np.where(valid[r, chosen], chosen, a)
+    return selected
 
 class Axis:
     def __init__(self, name=None, units=None):
         self.name = name
         self.units = units
         self.num = None
+        self.yrange_min = None
+        self.yrange_max = None
     def getLabel(self):
         if self.units and self.name:
             return "%s [%s]" % (self.name, self.units)
@@ -46,59 +139,47 @@ class Column:
         self.name = name
         self.units = units
         self.axis = axis
+        # Samples in the order of input (NaN for failed ones)
+        self.dates = array.array('d')
+        self.samples = array.array('d')
+        # Position of the last sample in the input (see Graph.finish())
+        self.last = 0
+        # Row of Graph.values
+        self.index = None
+        # Data file and the number of samples in it (see Store)
+        self.file = None
+        self.stored = 0
     def __repr__(self): return "Column(name=%s units=%s axis=%s)" % (self.name, self.units, repr(self.axis))
 
-class Row(dict):
-    def __init__(self, graph, date):
-        self.graph = graph
-        self.date = date
-    def __getitem__(self, column):
-        try:
-            return dict.__getitem__(self, column)
-        except KeyError:
-            return None
-    def getDate(self):
-        d = time.gmtime(time.mktime(self.date))
-        return "Date.UTC(%s, %s, %s, %s, %s, %s)" % \
-            (d.tm_year, d.tm_mon-1, d.tm_mday, d.tm_hour, d.tm_min, d.tm_sec)
-
 class Graph:
     def __init__(self, id, title):
         self.columns = {}
         self.columns_ordered = []
         self.id = id
         self.title = title
-        self.rows = []
-        self.date2row = {}
         self.axes = {}
         self.axes_ordered = []
+        self.count = 0
 
-    def __getitem__(self, date):
-        try:
-            rownum = self.date2row[date]
-        except KeyError:
-            rownum = len(self.rows)
-            self.date2row[date] = rownum
-        try:
-            return self.rows[rownum]
-        except IndexError:
-            self.rows[rownum:rownum] = [Row(self, date)]
-            return self.rows[rownum]
+        # Set by finish(): sorted dates (seconds since the epoch) of all
+        # samples and values of columns at these dates (NaN if missing)
+        self.dates = None
+        self.values = None
+        # Set by findSteps(): (column, index of the date, mean before, mean after)
+        self.steps = []
 
     def addValue(self, date, col, val, units):
-        row = self[date]
-        row[col] = val
-        if not self.columns.has_key(col):
+        column = self.columns.get(col)
+        if column is None:
             axis=self.getAxis(units) or self.addAxis(units, Axis(units=units))
             column = Column(col, units, axis)
             self.columns[col] = column
-            self.columns_ordered.append(column)
-        else:
-            column = self.columns[col]
-            self.columns_ordered.remove(column)
-            self.columns_ordered.append(column)
-        self.columns[col].units=units
-        self.columns[col].axis.units=units
+        column.units=units
+        column.axis.units=units
+        column.dates.append(date)
+        column.samples.append(np.nan if val is None else val)
+        self.count += 1
+        column.last = self.count
 
     def addAxis(self, key, axis):
         self.axes[key] = axis
@@ -108,31 +189,79 @@ class Graph:
         self.columns[col].axis = self.getAxis(key) or self.addAxis(key, Axis(name=key))
 
     def getAxis(self, key):
-        if not self.axes.has_key(key): return None
-        return self.axes[key]
+        return self.axes.get(key)
+
+    def finish(self):
+        """Convert the samples to the matrix of values. Columns are
+        ordered by their last sample. If there are more samples of a
+        column with the same date, the last one is used."""
+        self.columns_ordered = sorted(self.columns.values(), key=lambda col: col.last)
+        dates = [np.asarray(col.dates, np.float64) for col in self.columns_ordered]
+        self.dates = np.unique(np.concatenate(dates))
+        self.values = np.full((len(dates), len(self.dates)), np.nan)
+        for (index, (col, d)) in enumerate(zip(self.columns_ordered, dates)):
+            samples = np.asarray(col.samples, np.float64)
+            # np.unique returns the first occurrence, so search reversed
+            (d, last) = np.unique(d[::-1], return_index=True)
+            self.values[index, np.searchsorted(self.dates, d)] = samples[::-1][last]
+            col.index = index
+            col.dates = col.samples = None
+
+    def findSteps(self, window, threshold, change):
+        """Find steps in all columns at once. A step is at the date,
+        where the means of window samples before and after it differ
+        by at least the relative change and by threshold times the
+        standard error of the difference (Welch's t statistic). Only
+        the largest step within window dates on both sides is kept.
+        Missing values are skipped, but at least half of the samples of
+        both windows must be present."""
+        self.steps = []
+        (rows, n) = self.values.shape
+        if n < 2 * window:
+            return
+        valid = ~np.isnan(self.values)
+        values = np.where(valid, self.values, 0)
+        zeros = np.zeros((rows, 1))
+        # Prefix sums, so that sums of all windows are differences
+        counts = np.concatenate((zeros, np.cumsum(valid, axis=1)), axis=1)
+        sums = np.concatenate((zeros, np.cumsum(values, axis=1)), axis=1)
+        squares = np.concatenate((zeros, np.cumsum(values * values, axis=1)), axis=1)
+        # Windows before and after dates window .. n-window
+        (lo, mid, hi) = (np.arange(n - 2 * window + 1) + i * window for i in range(3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            (c1, c2) = (counts[:, mid] - counts[:, lo], counts[:, hi] - counts[:, mid])
+            m1 = (sums[:, mid] - sums[:, lo]) / c1
+            m2 = (sums[:, hi] - sums[:, mid]) / c2
+            v1 = np.maximum((squares[:, mid] - squares[:, lo]) - c1 * m1 * m1, 0) / (c1 - 1)
+            v2 = np.maximum((squares[:, hi] - squares[:, mid]) - c2 * m2 * m2, 0) / (c2 - 1)
+            score = np.abs(m2 - m1) / np.sqrt(v1 / c1 + v2 / c2)
+            found = ((score >= threshold) & (np.abs(m2 - m1) >= change * np.abs(m1)) &
+                     (np.minimum(c1, c2) >= max(window // 2, 2)))
+        score = np.where(found, score, 0)
+        padded = np.pad(score, ((0, 0), (window, window)))
+        found &= score == sliding_window_view(padded, 2 * window + 1, axis=1).max(axis=2)
+        for (row, i) in zip(*np.nonzero(found)):
+            self.steps.append((self.columns_ordered[row], int(i + window),
+                               float(m1[row, i]), float(m2[row, i])))
 
     def findRanges(self):
         for axis in self.axes.values():
-            cols = [col for col in self.columns.values() if col.axis == axis]
-            low = None
-            high = None
-            all_in_range = True
-            for col in cols:
-                values = np.array([row[col.name] for row in self.rows if row[col.name] != None], np.float64)
-                if low == None and high == None:
-                    lastmonth = values[-30:]
-                    median = np.median(lastmonth)
-                    low  = median * 0.95
-                    high = median * 1.05
-
-                if (values > high).any() or (values < low).any():
-                    all_in_range = False
-            if all_in_range:
+            rows = [col.index for col in self.columns.values() if col.axis == axis]
+            axis.yrange_max = None
+            axis.yrange_min = None
+            if not rows:
+                continue
+            values = self.values[rows]
+            first = values[0][~np.isnan(values[0])]
+            if not first.size:
+                continue
+            median = np.median(first[-30:])
+            low  = median * 0.95
+            high = median * 1.05
+            # Comparisons with NaN (missing values) are false
+            if not ((values > high) | (values < low)).any():
                 axis.yrange_max = high
                 axis.yrange_min = low
-            else:
-                axis.yrange_max = None
-                axis.yrange_min = None
 
     def fixupAxisNumbers(self):
         # Sort axes according to the columns and number them
@@ -148,11 +277,42 @@ class Graph:
             axis.num = num
             num += 1
 
-    def jschart(self):
-        print """
+    def dataFile(self, suffix='.json'):
+        """Name of the file with the data of the chart (see write()).
+        Different ids can give the same name after replacing special
+        characters, so a hash of the id is appended."""
+        digest = hashlib.sha1(self.id.encode()).hexdigest()[:8]
+        return 'data/{}-{}{}'.format(re.sub(r'[^\w.-]', '_', self.id), digest, suffix)
+
+    def chartData(self, points):
+        """Return the overview data of the chart with at most points
+        samples per column and the data with all samples."""
+        # Seconds since the epoch, the page converts them to milliseconds
+        dates = self.dates.astype(np.int64)
+        overview = {'count': len(dates), 'x': [], 'y': []}
+        for (row, index) in zip(self.values, lttb(self.dates, self.values, points)):
+            overview['x'].append(dates[index].tolist())
+            overview['y'].append(jsonValues(row[index]))
+        full = {'x': dates.tolist(), 'y': [jsonValues(row) for row in self.values]}
+        return (overview, full)
+
+    def jschart(self, out=sys.stdout, lazy=False):
+        """Write JavaScript code creating the chart. If lazy, the chart
+        is created with data loaded from dataFile() when it is
+        displayed, otherwise the data are included in the code."""
+        if lazy:
+            out.write("""
+		lazyChart('"""+self.id+"""', '"""+self.dataFile()+"""', function(data) {""")
+        out.write("""
 			window.chart = new Highcharts.StockChart({
 			    chart: {
-			        renderTo: '"""+self.id+"""'
+			        renderTo: '"""+self.id+"""'""")
+        if lazy:
+            out.write(""",
+			        events: {
+			            load: function() { showDetail(this, '"""+self.dataFile()+"""', this.xAxis[0].getExtremes()); }
+			        }""")
+        out.write("""
 			    },
 
 			    rangeSelector: {
@@ -171,6 +331,7 @@ class Graph:
                             },
                             tooltip: {
                                 formatter: function() {
+                                    if (!this.points) return this.point.text;
                                     var s = '<b>'+ Highcharts.dateFormat('%a, %d %b %Y %H:%M:%S', this.x) +'</b><br/>';
                                     s += commitMap[this.x].msg;
                                     $.each(this.points, function(i, point) {
@@ -202,105 +363,257 @@ class Graph:
 		                    }
 		                }
 		            },
-			    yAxis: ["""
-	for axis in self.axes_ordered:
-            print "\t\t\t\t{"
-            print "\t\t\t\t\tlineWidth: 1,"
-            print "\t\t\t\t\tlabels: { align: 'right', x: -3 },"
-            print "\t\t\t\t\ttitle: { text: '%s' }," % axis.getLabel()
-            #print "\t\t\t\t\tplotBands: { from: %s, to: %s, color: '#eee' }," % (col.low, col.high)
-            if axis.yrange_min: print "\t\t\t\t\tmin: %s," % axis.yrange_min
-            if axis.yrange_max: print "\t\t\t\t\tmax: %s," % axis.yrange_max
-            print "\t\t\t\t},"
-        print """\t\t\t    ],
-
-			    series: ["""
-        num = 0
-	for col in self.columns_ordered:
-            print "\t\t\t\t{ name: '%s [%s]', yAxis: %d, data: [" % (col.name, col.units, col.axis.num)
-            num += 1
-            for row in self.rows:
-                val = row[col.name]
-                if val == None: val = "null"
-                print "\t\t\t\t\t[%s, %s], " % (row.getDate(), val)
-            print "\t\t\t\t]},"
-        print """\t\t\t    ],
-			});"""
-
-class Graphs(dict):
-    pass
-
-graphs = Graphs()
-commits = {}
-
-date = time.localtime(time.time())
-
-for line in sys.stdin.readlines():
-    line = line.rstrip()
-
-    match = re_date.match(line)
-    if (match):
-        date = time.strptime(match.group(1), "%a, %d %b %Y %H:%M:%S +0200")
-        continue
-
-    match = re_testing.match(line)
-    if match:
-        what = match.group(2)
-        where = match.group(3)
-
-        match = re_commit.match(what)
-        if match:
-            date = time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
-            commit = match.group(2)
-            match = re_commithash.search(commit);
+""")
+        if lazy:
+            out.write("""
+			    navigator: { adaptToUpdatedData: false },
+			    xAxis: {
+			        events: {
+			            afterSetExtremes: function(e) { showDetail(this.chart, '"""+self.dataFile()+"""', e); }
+			        }
+			    },
+""")
+        out.write("""			    yAxis: [
+""")
+        for axis in self.axes_ordered:
+            out.write("\t\t\t\t{\n")
+            out.write("\t\t\t\t\tlineWidth: 1,\n")
+            out.write("\t\t\t\t\tlabels: { align: 'right', x: -3 },\n")
+            out.write("\t\t\t\t\ttitle: { text: '%s' },\n" % axis.getLabel())
+            if axis.yrange_min: out.write("\t\t\t\t\tmin: %s,\n" % axis.yrange_min)
+            if axis.yrange_max: out.write("\t\t\t\t\tmax: %s,\n" % axis.yrange_max)
+            out.write("\t\t\t\t},\n")
+        out.write("""\t\t\t    ],
+
+			    series: [
+""")
+        if lazy:
+            for col in self.columns_ordered:
+                out.write("\t\t\t\t{ name: '%s [%s]', id: 'c%d', yAxis: %d, data: data[%d] },\n" %
+                          (col.name, col.units, col.index, col.axis.num, col.index))
+        else:
+            dates = [jsDate(d) for d in self.dates]
+            for col in self.columns_ordered:
+                out.write("\t\t\t\t{ name: '%s [%s]', id: 'c%d', yAxis: %d, data: [\n" %
+                          (col.name, col.units, col.index, col.axis.num))
+                values = ['null' if v != v else repr(v) for v in self.values[col.index].tolist()]
+                out.writelines("\t\t\t\t\t[%s, %s], \n" % point for point in zip(dates, values))
+                out.write("\t\t\t\t]},\n")
+        self.jsflags(out)
+        out.write("""\t\t\t    ],
+			});
+""")
+        if lazy:
+            out.write("\t\t});\n")
+
+    def jsflags(self, out):
+        "Write series of flags marking the steps found by findSteps()."
+        flags = {}
+        for (col, index, before, after) in self.steps:
+            flags.setdefault(col.index, []).append((index, formatChange(before, after, '%+.0f%%')))
+        for (row, steps) in sorted(flags.items()):
+            out.write("""\t\t\t\t{ type: 'flags', onSeries: 'c%d', events: {
+					click: function(event) {
+					    window.location = "http://os.inf.tu-dresden.de/~jsteckli/cgi-bin/cgit.cgi/nul/log/?id="+commitMap[event.point.x].hash;
+					}
+				  }, data: [
+""" % row)
+            for (index, change) in steps:
+                date = int(1000 * self.dates[index])
+                out.write("\t\t\t\t\t{ x: %d, title: '%s', text: commitMap[%d] ? commitMap[%d].msg : '' },\n" %
+                          (date, change, date, date))
+            out.write("\t\t\t\t]},\n")
+
+def parse(lines, graphs, commits, date=None):
+    """Add PERF results from lines of wvtest output to graphs (name ->
+    Graph) and commits (date -> (commit, hash)). Return the date of the
+    last results."""
+    if date is None:
+        date = time.time()
+    graph = None
+    for line in lines:
+        if line.startswith('Date: '):
+            match = re_date.match(line)
+            date = parseDate(match.group(1), "%a, %d %b %Y %H:%M:%S +0200")
+            continue
+
+        if 'Testing "' in line:
+            match = re_testing.match(line)
             if match:
-                commithash = match.group(1)
-            else:
-                commithash = None
-            commits[date] = (commit, commithash)
-
-        (basename, ext) = os.path.splitext(os.path.basename(where))
-
-        if what != "all": title = what
-        else: title = basename
-        try:
-            graph = graphs[basename]
-        except KeyError:
-            graph = Graph(basename, title)
-            graphs[basename] = graph
-        continue
-
-    match = re_perf.match(line)
-    if match:
-        perfstr = match.group(3)
-        perf = perfstr.split()
-        col = perf[0]
-        try:
-            val = float(perf[1])
-        except ValueError:
-            val = None
-        try:
-            units = perf[2]
-            if '=' in units: units = None
-        except:
-            units = None
-        if match.group(4) != "ok":
-            val=None
-
-        graph.addValue(date, col, val, units)
-
-        match = re_perfaxis.search(perfstr)
-        if match:
-            graph.setAxis(col, match.group(1));
-
-graphs = [g for g in graphs.values() if len(g.columns)]
-graphs = sorted(graphs, key=lambda g: g.title.lower())
-
-for g in graphs:
-    g.findRanges()
-    g.fixupAxisNumbers()
+                what = match.group(2)
+                where = match.group(3)
+
+                match = re_commit.match(what)
+                if match:
+                    date = parseDate(match.group(1), "%Y-%m-%d %H:%M:%S")
+                    commit = match.group(2)
+                    match = re_commithash.search(commit)
+                    if match:
+                        commithash = match.group(1)
+                    else:
+                        commithash = None
+                    commits[date] = (commit, commithash)
+
+                (basename, ext) = os.path.splitext(os.path.basename(where))
+
+                if what != "all": title = what
+                else: title = basename
+                graph = graphs.get(basename)
+                if graph is None:
+                    graph = Graph(basename, title)
+                    graphs[basename] = graph
+                continue
+
+        if 'PERF:' in line and graph is not None:
+            match = re_perf.match(line)
+            if match:
+                perfstr = match.group(3)
+                perf = perfstr.split()
+                col = perf[0]
+                try:
+                    val = float(perf[1])
+                except (ValueError, IndexError):
+                    val = None
+                units = perf[2] if len(perf) > 2 and '=' not in perf[2] else None
+                if match.group(4) != "ok":
+                    val=None
+
+                graph.addValue(date, col, val, units)
+
+                match = re_perfaxis.search(perfstr)
+                if match:
+                    graph.setAxis(col, match.group(1))
+    return date
+
+def prepare(graphs):
+    "Return the list of non-empty graphs ready for output."
+    graphs = [g for g in graphs.values() if len(g.columns)]
+    graphs = sorted(graphs, key=lambda g: g.title.lower())
+
+    for g in graphs:
+        g.finish()
+        g.findRanges()
+        g.fixupAxisNumbers()
+    return graphs
+
+def higherIsBetter(units):
+    "Units of rates like MB/s are better when higher, others when lower."
+    return '/' in (units or '')
+
+def formatChange(before, after, format):
+    """Format the relative change in percent. Changes from zero (e.g.
+    of a number of errors) are given as absolute differences."""
+    if before == 0:
+        return '%+.4g' % (after - before)
+    return format % (100 * (after - before) / abs(before))
+
+def changes(graphs, commits):
+    """Return the steps found in graphs as a list of dicts ordered by
+    the size of the relative change. Changes from zero have no
+    relative change (None) and go first."""
+    result = []
+    for graph in graphs:
+        for (col, index, before, after) in graph.steps:
+            date = float(graph.dates[index])
+            (commit, commithash) = commits.get(date, (None, None))
+            change = (after - before) / abs(before) if before else None
+            result.append({
+                'graph': graph.id, 'title': graph.title, 'series': col.name, 'units': col.units,
+                'date': date, 'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(date)),
+                'commit': commit, 'hash': commithash,
+                'before': before, 'after': after, 'change': change,
+                'regression': bool((after < before) == higherIsBetter(col.units)),
+            })
+    result.sort(key=lambda c: math.inf if c['change'] is None else abs(c['change']), reverse=True)
+    return result
+
+def summary(steps, out):
+    "Write tables of the largest regressions and improvements."
+    for (heading, regression) in (('Largest regressions', True), ('Largest improvements', False)):
+        rows = [c for c in steps if c['regression'] == regression][:summary_size]
+        if not rows:
+            continue
+        out.write("	<h2>%s</h2>\n	<table>\n" % heading)
+        out.write("	<tr><th>Graph</th><th>Series</th><th>Date</th><th>Commit</th>"
+                  "<th>Before</th><th>After</th><th>Change</th></tr>\n")
+        for c in rows:
+            out.write("	<tr><td><a href='#%s'>%s</a></td><td>%s [%s]</td><td>%s</td><td>%s</td>"
+                      "<td>%.4g</td><td>%.4g</td><td>%s</td></tr>\n" %
+                      (c['title'], c['title'], c['series'], c['units'], c['time'],
+                       escape(c['commit'] or ''), c['before'], c['after'],
+                       formatChange(c['before'], c['after'], '%+.1f%%')))
+        out.write("	</table>\n")
+
+# Functions of the page with charts loaded by lazyChart()
+lazy_js = """
+		var overviews = {};
+		var fullData = {};
+		function points(x, y) {
+			var data = [];
+			for (var i = 0; i < x.length; i++)
+				data.push([1000 * x[i], y[i]]);
+			return data;
+		}
+		function bisect(a, x) {
+			var lo = 0, hi = a.length;
+			while (lo < hi) {
+				var mid = (lo + hi) >> 1;
+				if (a[mid] < x) lo = mid + 1; else hi = mid;
+			}
+			return lo;
+		}
+		// Create the chart when its element is scrolled into view
+		function lazyChart(id, file, create) {
+			var loaded = false;
+			function load() {
+				if (loaded) return;
+				loaded = true;
+				$.getJSON(file, function(overview) {
+					var data = [];
+					for (var i = 0; i < overview.x.length; i++)
+						data.push(points(overview.x[i], overview.y[i]));
+					overviews[file] = { count: overview.count, data: data };
+					create(data);
+				});
+			}
+			if (window.IntersectionObserver) {
+				new IntersectionObserver(function(entries, observer) {
+					if (entries[0].isIntersecting) {
+						observer.disconnect();
+						load();
+					}
+				}, { rootMargin: '400px' }).observe(document.getElementById(id));
+			} else
+				load();
+		}
+		// Show all samples of the selected range unless there are
+		// too many of them, otherwise the downsampled overview
+		function showDetail(chart, file, e) {
+			var overview = overviews[file];
+			function show(full) {
+				var lo = Math.max(bisect(full.x, e.min / 1000) - 1, 0);
+				var hi = Math.min(bisect(full.x, e.max / 1000) + 1, full.x.length);
+				for (var i = 0; i < full.y.length; i++)
+					chart.series[i].setData(hi - lo <= maxPoints ?
+						points(full.x.slice(lo, hi), full.y[i].slice(lo, hi)) :
+						overview.data[i], false);
+				chart.redraw();
+			}
+			if (overview.count <= maxPoints)
+				return;
+			if (file in fullData)
+				show(fullData[file]);
+			else
+				$.getJSON(file.replace(/\\.json$/, '.full.json'), function(full) {
+					show(fullData[file] = full);
+				});
+		}
+"""
 
-print """
+def html(graphs, commits, out=sys.stdout, maxPoints=None):
+    """Write the page with charts of graphs. If maxPoints is given, the
+    data of the charts are loaded from files written by write()."""
+    out.write("""
 <!DOCTYPE HTML>
 <html>
     <head>
@@ -309,15 +622,21 @@ print """
 
 	<script type="text/javascript" src="http://ajax.googleapis.com/ajax/libs/jquery/1.6.1/jquery.min.js"></script>
 	<script type="text/javascript">
-		var commitMap = {"""
-for d in sorted(commits.iterkeys()):
-    v = commits[d];
-    print '\t\t\t%d: { msg: "%s", hash: "%s" },' % (1000*time.mktime(d), v[0].replace('"', '\\"'), str(v[1]).replace('"', '\\"'))
-print """\t\t};
-		$(function() {"""
-for graph in graphs:
-    graph.jschart()
-print """
+		var commitMap = {
+""")
+    for d in sorted(commits):
+        v = commits[d]
+        out.write('\t\t\t%d: { msg: "%s", hash: "%s" },\n' % (1000*d, v[0].replace('"', '\\"'), str(v[1]).replace('"', '\\"')))
+    out.write("""\t\t};
+""")
+    if maxPoints is not None:
+        out.write("\t\tvar maxPoints = %d;" % maxPoints)
+        out.write(lazy_js)
+    out.write("""		$(function() {
+""")
+    for graph in graphs:
+        graph.jschart(out, maxPoints is not None)
+    out.write("""
 		});
 	</script>
     </head>
@@ -325,18 +644,223 @@ print """
     <body>
 	<h1>NUL Performance Plots</h1>
 	<script type="text/javascript" src="js/highstock.js"></script>
-        <ul>
-"""
-for graph in graphs:
-    print "	<li><a href='#%s'>%s</a></li>" % (graph.title, graph.title)
-print "    </ul>"
-for graph in graphs:
-    print "	<h2><a name='%s'>%s</a></h2>" % (graph.title, graph.title)
-    print '	<div id="%s" style="height: 400px"></div>' % graph.id
-print """
+""")
+    summary(changes(graphs, commits), out)
+    out.write("""        <ul>
+
+""")
+    for graph in graphs:
+        out.write("	<li><a href='#%s'>%s</a></li>\n" % (graph.title, graph.title))
+    out.write("    </ul>\n")
+    for graph in graphs:
+        out.write("	<h2><a name='%s'>%s</a></h2>\n" % (graph.title, graph.title))
+        out.write('	<div id="%s" style="height: 400px"></div>\n' % graph.id)
+    out.write("""
     </body>
 </html>
-"""
+
+""")
+
+def write(graphs, commits, directory, points):
+    """Write the page with charts of graphs to directory/index.html and
+    their data to directory/data. Series with more than the given
+    number of points are downsampled for the overview."""
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    for graph in graphs:
+        (overview, full) = graph.chartData(points)
+        for (data, suffix) in ((overview, '.json'), (full, '.full.json')):
+            with open(os.path.join(directory, graph.dataFile(suffix)), 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+    with open(os.path.join(directory, 'index.html'), 'w') as f:
+        html(graphs, commits, f, points)
+
+def output(args, graphs, commits):
+    graphs = prepare(graphs)
+    for graph in graphs:
+        graph.findSteps(args.window, args.threshold, args.min_change / 100)
+    if args.changes:
+        with open(args.changes, 'w') as f:
+            json.dump(changes(graphs, commits), f, indent=1)
+    if args.output:
+        write(graphs, commits, args.output, args.max_points)
+    else:
+        html(graphs, commits)
+
+class Store:
+    """Persistent store of parsed results, so that every log is parsed
+    only once. It is a directory with index.json, which describes the
+    graphs, their columns and axes, commits and SHA-256 hashes of the
+    ingested logs, and one data file per column with little-endian
+    (date, value) pairs of doubles. New samples are appended to the
+    data files before the index is (atomically) replaced, so only the
+    number of samples recorded in the index is valid."""
+
+    version = 1
+    record = np.dtype([('date', '<f8'), ('value', '<f8')])
+
+    def __init__(self, path):
+        self.path = path
+        self.graphs = {}
+        self.commits = {}
+        self.logs = []
+        self.hashes = set()
+        self.date = None
+        self.files = 0
+        try:
+            with open(os.path.join(path, 'index.json')) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        if index.get('version') != self.version:
+            sys.exit("{}: Unsupported store version".format(path))
+        self.logs = index['logs']
+        self.hashes = set(self.logs)
+        self.date = index['date']
+        self.files = index['files']
+        self.commits = {date: (commit, commithash) for (date, commit, commithash) in index['commits']}
+        for g in index['graphs']:
+            graph = Graph(g['id'], g['title'])
+            graph.count = g['count']
+            axes = [graph.addAxis(key, Axis(name, units)) for (key, name, units) in g['axes']]
+            for c in g['columns']:
+                column = Column(c['name'], c['units'], axes[c['axis']])
+                (column.last, column.file, column.stored) = (c['last'], c['file'], c['stored'])
+                graph.columns[column.name] = column
+            self.graphs[graph.id] = graph
+
+    def ingest(self, data: bytes):
+        "Parse a log unless it was already ingested. Return True if it was new."
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self.hashes:
+            return False
+        # Universal newlines as for standard input, logs may have CRLF
+        self.date = parse(io.TextIOWrapper(io.BytesIO(data), 'utf-8', 'replace'),
+                          self.graphs, self.commits, self.date)
+        self.logs.append(digest)
+        self.hashes.add(digest)
+        return True
+
+    def save(self):
+        "Append new samples to the data files and write the index."
+        os.makedirs(self.path, exist_ok=True)
+        index = {
+            'version': self.version,
+            'logs': self.logs,
+            'date': self.date,
+            'commits': [(date, commit, commithash) for (date, (commit, commithash))
+                        in sorted(self.commits.items())],
+            'graphs': [],
+        }
+        for graph in self.graphs.values():
+            axes = list(graph.axes.items())
+            axisIndex = {id(axis): i for (i, (key, axis)) in enumerate(axes)}
+            columns = []
+            for column in graph.columns.values():
+                if column.file is None:
+                    column.file = '{}.dat'.format(self.files)
+                    self.files += 1
+                if len(column.dates):
+                    records = np.empty(len(column.dates), self.record)
+                    records['date'] = column.dates
+                    records['value'] = column.samples
+                    with open(os.path.join(self.path, column.file), 'ab') as f:
+                        # Drop samples not recorded in the index
+                        f.truncate(column.stored * self.record.itemsize)
+                        f.write(records.tobytes())
+                    column.stored += len(records)
+                    column.dates = array.array('d')
+                    column.samples = array.array('d')
+                columns.append({'name': column.name, 'units': column.units,
+                                'axis': axisIndex[id(column.axis)], 'last': column.last,
+                                'file': column.file, 'stored': column.stored})
+            index['graphs'].append({'id': graph.id, 'title': graph.title, 'count': graph.count,
+                                    'axes': [(key, axis.name, axis.units) for (key, axis) in axes],
+                                    'columns': columns})
+        index['files'] = self.files
+        with tempfile.NamedTemporaryFile('w', dir=self.path, delete=False) as f:
+            json.dump(index, f)
+        os.replace(f.name, os.path.join(self.path, 'index.json'))
+
+    def load(self):
+        "Load the samples of all columns for output."
+        for graph in self.graphs.values():
+            for column in graph.columns.values():
+                records = np.fromfile(os.path.join(self.path, column.file), self.record,
+                                      count=column.stored)
+                column.dates = records['date']
+                column.samples = records['value']
+        return self.graphs
+
+def do_ingest(args):
+    store = Store(args.store)
+    for fn in args.logs:
+        if fn == '-':
+            data = sys.stdin.buffer.read()
+        else:
+            with open(fn, 'rb') as f:
+                data = f.read()
+        if not store.ingest(data) and args.verbose:
+            print("{}: already ingested".format(fn), file=sys.stderr)
+    store.save()
+
+def do_html(args):
+    store = Store(args.store)
+    output(args, store.load(), store.commits)
+
+def maxPointsArg(value):
+    "Argument type of --max-points - lttb() needs at least 3 points."
+    try:
+        points = int(value)
+    except ValueError:
+        points = 0
+    if points < 3:
+        raise argparse.ArgumentTypeError("'{}' is not a number of at least 3".format(value))
+    return points
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='''Convert wvtest output with PERF results to HTML graphs. Without
+        a sub-command, the output is read from standard input.''')
+    parser.add_argument('-o', '--output', metavar='DIR',
+                        help='''Write the page to DIR/index.html and the data of the graphs
+                        to DIR/data instead of including them in the page''')
+    parser.add_argument('--max-points', type=maxPointsArg, default=500, metavar='N',
+                        help='''Downsample series in DIR/data to N points; all samples are
+                        shown for ranges with at most N of them (default %(default)s)''')
+    parser.add_argument('--window', type=int, default=10, metavar='N',
+                        help='''Compare means of N samples before and after every date to
+                        find steps (default %(default)s)''')
+    parser.add_argument('--threshold', type=float, default=5, metavar='T',
+                        help='''Minimum difference of the means in standard errors
+                        (default %(default)s)''')
+    parser.add_argument('--min-change', type=float, default=5, metavar='PCT',
+                        help='''Minimum difference of the means in percent
+                        (default %(default)s)''')
+    parser.add_argument('--changes', metavar='FILE',
+                        help='Write the steps found in all series to FILE as JSON')
+    subparsers = parser.add_subparsers()
+    parser_ingest = subparsers.add_parser('ingest', help='Add logs to a store of parsed results')
+    parser_ingest.add_argument('-v', '--verbose', action='store_true',
+                               help='Report logs that were already ingested')
+    parser_ingest.add_argument('store', help='Store directory (created if needed)')
+    parser_ingest.add_argument('logs', nargs='+', metavar='LOG',
+                               help='Log files (in chronological order), - for standard input')
+    parser_ingest.set_defaults(func=do_ingest)
+    parser_html = subparsers.add_parser('html', help='Generate HTML from a store')
+    parser_html.add_argument('store', help='Store directory')
+    parser_html.set_defaults(func=do_html)
+    args = parser.parse_args()
+
+    if 'func' in args:
+        args.func(args)
+    else:
+        graphs = {}
+        commits = {}
+        parse(io.TextIOWrapper(sys.stdin.buffer, errors='replace'), graphs, commits)
+        output(args, graphs, commits)
+
+if __name__ == '__main__':
+    main()
 
 # Local Variables:
 # compile-command: "cat nul-nightly/nul_*.log|./wvperfpreprocess.py|./wvperf2html.py > graphs.html"
@@ -11,58 +11,95 @@ compatible with Jenkins JUnit plugin was implemented.
 """
 
 import datetime
-import types
 import inspect
+import itertools
 import sys
-from xml.sax.saxutils import escape, quoteattr
 
 escEntities = dict([(chr(i), "&#%d;"%i) for i in range(1, 32) if i not in [ord("\t"), ord("\n"), ord("\r")]])
 
 # Null character is not alowed in XML document. Remove it.
 escEntities['\x00'] = ''
 
+# Translation tables escaping XML special characters and the characters
+# in escEntities in a single pass over the string.
+_textTable = str.maketrans(dict(escEntities, **{'&': '&amp;', '<': '&lt;', '>': '&gt;'}))
+_attrTable = str.maketrans(dict(escEntities, **{'&': '&amp;', '<': '&lt;', '>': '&gt;',
+                                                '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}))
+
+def escapeText(text):
+    """Escape &, <, > and the characters in escEntities for use in a
+    text node."""
+    return text.translate(_textTable)
+
+def escapeAttr(text):
+    """Escape text as escapeText() does and also newlines and tabs, and
+    quote it for use as an attribute value. The quotes are chosen so
+    that they need not be escaped, if possible."""
+    text = text.translate(_attrTable)
+    if '"' in text:
+        if "'" in text:
+            return '"' + text.replace('"', "&quot;") + '"'
+        return "'" + text + "'"
+    return '"' + text + '"'
+
+class EscapedValues:
+    """Values of JUnitBase members escaped for use in text nodes (as
+    'member') and in attributes (as 'member_attr'). The values are
+    escaped only when they are used in a template."""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __getattr__(self, attr):
+        if attr.endswith('_attr'):
+            return escapeAttr(str(getattr(self.obj, attr[:-5])))
+        val = getattr(self.obj, attr)
+        if type(val) is float:
+            return val
+        return escapeText(str(val))
+
 class JUnitBase:
-    def _get_valid_members(self):
-        return [x for x in dir(self.__class__)
-                if not x.startswith('_') and
-                   not inspect.isfunction(getattr(self.__class__, x))]
+    @classmethod
+    def _get_valid_members(cls):
+        # Computed once per class - dir() and inspection are slow
+        try:
+            return cls.__dict__['_valid_members']
+        except KeyError:
+            cls._valid_members = members = tuple(
+                x for x in dir(cls)
+                if not x.startswith('_') and not inspect.isfunction(getattr(cls, x)))
+            return members
 
     def __init__(self, **kwargs):
         """Initialize the object with kwargs as specified by class variables."""
+        cls = self.__class__
         valid_members = self._get_valid_members()
         for (key, val) in kwargs.items():
             if key in valid_members:
-                if type(val) == getattr(self.__class__, key) or val == None:
+                if isinstance(val, getattr(cls, key)) or val == None:
                     v = val
                 else:
                     try:
-                        v = getattr(self.__class__, key).__call__(val) # Construct the right type
+                        v = getattr(cls, key).__call__(val) # Construct the right type
                     except Exception as exc:
                         raise Exception("Cannot construct '{}' from '{}'".format(key, val)) from  exc
                 setattr(self, key, v)
             else:
-                raise(Exception("'{key}' is not a valid member of '{cls}'".format(key=key, cls=self.__class__.__name__)))
+                raise(Exception("'{key}' is not a valid member of '{cls}'".format(key=key, cls=cls.__name__)))
 
         for key in valid_members:
             if key not in kwargs:
-                setattr(self, key, getattr(self.__class__, key).__call__())
+                setattr(self, key, getattr(cls, key).__call__())
 
     def escaped_values(self):
-        class EscapedObject(object): pass
-        ret = EscapedObject()
-        for attr in self._get_valid_members():
-            if type(getattr(self, attr)) not in [float]:
-                # Encode each attribute in two ways - for use in text
-                # nodes and for use in attributes.
-                setattr(ret, attr, escape(str(getattr(self, attr)), escEntities))
-                setattr(ret, attr+"_attr", quoteattr(str(getattr(self, attr)), escEntities))
-            else:
-                setattr(ret, attr, getattr(self, attr))
-        return ret
+        return EscapedValues(self)
 
     def print(self, file=sys.stdout):
-        if str(self):
-            print(str(self), file=file)
+        s = str(self)
+        if s:
+            file.write(s + '\n')
 
 class Property(JUnitBase):
     name = str
@@ -92,6 +129,31 @@ class SystemOut(JUnitBase):
         else:
             return ''
 
+class SystemOutStream(SystemOut):
+    """<system-out/> with the text given as an iterable of lines (without
+    newlines). The lines are consumed while printing, so they can be
+    read e.g. from a file without having the whole text in memory."""
+
+    _chunk_lines = 4096
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def print(self, file=sys.stdout):
+        file.write('<system-out>')
+        empty = True
+        lines = iter(self.lines)
+        while True:
+            chunk = list(itertools.islice(lines, self._chunk_lines))
+            if not chunk:
+                break
+            chunk.append('')
+            file.write('\n'.join(chunk).translate(_textTable))
+            empty = False
+        if empty:
+            file.write('\n')
+        file.write('</system-out>\n')
+
 class Testcase(JUnitBase):
     classname = str
     name = str
@@ -99,17 +161,18 @@ class Testcase(JUnitBase):
     system_out = SystemOut
     failure = Failure
 
-    def print(self, file=sys.stdout):
-        print(('<testcase'
-               ' classname={self.classname_attr}'
-               ' name={self.name_attr}'
-               ' time="{self.time:.3f}">').format(self=self.escaped_values()),
-               file = file)
+    def __str__(self):
+        s = '<testcase classname={} name={} time="{:.3f}">\n'.format(
+            escapeAttr(str(self.classname)), escapeAttr(str(self.name)), self.time)
         if self.failure:
-            self.failure.print(file)
+            f = str(self.failure)
+            if f:
+                s += f + '\n'
         if self.system_out:
-            self.system_out.print(file)
-        print("</testcase>", file=file)
+            o = str(self.system_out)
+            if o:
+                s += o + '\n'
+        return s + '</testcase>'
 
 class Testsuite(JUnitBase):
     errors = int
@@ -126,23 +189,71 @@ class Testsuite(JUnitBase):
 
     def print(self, file = sys.stdout):
         ts = self.timestamp.replace(microsecond=0)
-        print('<testsuite tests="{self.tests}" errors="{self.errors}" failures="{self.failures}" hostname={self.hostname_attr} name={self.name_attr} time="{self.time:.3f}" timestamp="{timestamp}">'.format(self=self.escaped_values(), timestamp=ts.isoformat()),
-              file = file)
-        print("<properties>", file=file)
-        for p in self.properties:
-            p.print(file=file)
-        print("</properties>", file=file)
-        for t in self.testcases:
-            t.print(file=file)
+        # Everything except <system-out/> is written at once
+        parts = ['<testsuite tests="{self.tests}" errors="{self.errors}" failures="{self.failures}" hostname={self.hostname_attr} name={self.name_attr} time="{self.time:.3f}" timestamp="{timestamp}">\n'.format(self=self.escaped_values(), timestamp=ts.isoformat()),
+                 '<properties>\n']
+        parts.extend(s + '\n' for s in map(str, self.properties) if s)
+        parts.append('</properties>\n')
+        parts.extend(str(t) + '\n' for t in self.testcases)
+        file.write(''.join(parts))
         self.system_out.print(file=file)
-        print("</testsuite>", file=file)
+        file.write('</testsuite>\n')
 
 class Testsuites(JUnitBase):
     testsuites = list
 
     def print(self, file = sys.stdout):
-        print('<?xml version="1.1" encoding="UTF-8" ?>', file=file)
-        print('<testsuites>', file = file)
+        file.write('<?xml version="1.1" encoding="UTF-8" ?>\n<testsuites>\n')
         for t in self.testsuites:
             t.print(file=file)
-        print("</testsuites>", file=file)
+        file.write("</testsuites>\n")
+
+class Writer:
+    """Writes JUnit XML document incrementally, one testsuite at a time.
+
+    If the file is seekable, the closing tag of the document is written
+    after every testsuite (and overwritten by the next one), so that the
+    file is a valid XML document containing all finished testsuites
+    even if we are killed. With document=False, only the testsuites
+    are written (to be later copied to another document by
+    writeRaw())."""
+
+    header = '<?xml version="1.1" encoding="UTF-8" ?>\n<testsuites>\n'
+    footer = '</testsuites>\n'
+
+    def __init__(self, file, document=True):
+        self.file = file
+        self.document = document
+        self.end = None
+        if document:
+            file.write(self.header)
+            self._writeFooter()
+
+    def _writeFooter(self):
+        try:
+            self.end = self.file.tell()
+        except (OSError, ValueError):
+            self.end = None
+            return
+        self.file.write(self.footer)
+        self.file.flush()
+
+    def writeRaw(self, lines):
+        "Write an iterable of (already escaped) XML text."
+        if self.end is not None:
+            self.file.seek(self.end)
+        self.file.writelines(lines)
+        if self.document:
+            self._writeFooter()
+
+    def write(self, testsuite: Testsuite):
+        if self.end is not None:
+            self.file.seek(self.end)
+        testsuite.print(file=self.file)
+        if self.document:
+            self._writeFooter()
+
+    def close(self):
+        if self.document and self.end is None:
+            self.file.write(self.footer)
+        self.file.flush()
@@ -8,8 +8,9 @@ provides some other useful features. Namely:
 - Summary mode (--summary)
 - Test results aligned to the same column
 - (Experimental) Export to JUnit XML
+- Parallel execution of multiple commands (runall -j)
+- Variable timeout ("wvtest: timeout N" and "wvtest: section timeout N")
 - TODO: Conversion to HTML
-- TODO: Variable timeout
 - TODO: Checking of expected number of tests
 
 Newest version can be found at https://github.com/wentasah/wvtest.
@@ -28,10 +29,37 @@ import io
 import datetime
 import time
 import socket
+import collections
+import tempfile
+import operator
+import selectors
+import json
+import hashlib
+import shutil
+import heapq
+import itertools
+import gzip
+import fnmatch
+import struct
+import multiprocessing
+import mmap
+import pickle
 
 # Regulr expression that matches potential prefixes to wvtest protocol lines
 re_prefix = ''
 
+# Encoding of wvtest output. Invalid characters are replaced when decoding.
+encoding = 'utf-8'
+
+# Size of chunks read from the output of supervised commands
+_read_size = 256 * 1024
+# Number of protocol lines per _read_size bytes, above which _scanFile()
+# splits files to lines rather than searching for protocol lines
+_dense_lines = 128
+
+# How often format --follow checks whether the file has grown (seconds)
+_follow_interval = 1.0
+
 class Term:
     class attr:
         reset         = '\033[0m'
@@ -69,6 +97,12 @@ class Term:
 
     progress_chars = '|/-\\'
 
+    # Minimum time between redraws of the progress message (seconds)
+    redraw_interval = 0.2
+
+    # Maximum number of rows shown below the progress message
+    max_progress_rows = 10
+
     def __init__(self, width=None):
         if not 'TERM'  in os.environ or os.environ['TERM'] == 'dumb':
             self.output = None
@@ -82,6 +116,10 @@ class Term:
         self._enabled = True
         self._progress_msg = ''
         self._progress_idx = 0
+        self._progress_rows = None
+        self._next_redraw = 0
+        self._drawn_msg = ''
+        self._drawn_rows = 0
 
     def _raw_write(self, string):
         '''Write raw data if output is enabled.'''
@@ -115,25 +153,95 @@ class Term:
 
     def set_progress_msg(self, msg):
         self._progress_msg = msg
-        self._progress_idx = 0
         self.update_progress_msg()
 
+    def set_progress_rows(self, rows):
+        """Set a function returning additional lines shown below the
+        progress message (e.g. concurrently running commands), or None."""
+        self._progress_rows = rows
+
     def update_progress_msg(self):
+        """Redraw the progress message, but not more often than every
+        redraw_interval seconds. This is called for every line of
+        output, so it must be cheap when nothing is drawn."""
+        now = time.monotonic()
+        if now >= self._next_redraw:
+            self._next_redraw = now + self.redraw_interval
+            self._redraw()
+
+    def _redraw(self):
+        if not self.output:
+            return
         self._progress_idx += 1
         if self._progress_idx >= len(self.progress_chars):
             self._progress_idx = 0
-        if self.output:
-            self._raw_write(self._progress_msg[:self.width - 3] + " " + self.progress_chars[self._progress_idx] + "\r")
+        msg = self._progress_msg[:self.width - 3] + " " + self.progress_chars[self._progress_idx]
+        rows = self._progress_rows() if self._progress_rows else []
+        if len(rows) > self.max_progress_rows:
+            rows[self.max_progress_rows - 1:] = ['... and {} more'.format(len(rows) - self.max_progress_rows + 1)]
+        if rows or self._drawn_rows:
+            # Draw the rows below the message, erase the rest of the
+            # previously drawn ones and move back to the first line.
+            self._raw_write(msg + '\033[K' +
+                            ''.join('\n' + row[:self.width - 1] + '\033[K' for row in rows) +
+                            '\033[J' + ('\033[{}A'.format(len(rows)) if rows else '') + '\r')
+            self._drawn_rows = len(rows)
+        else:
+            self._raw_write(msg + "\r")
+        self._drawn_msg = msg
 
     def clear_progress_msg(self):
         if self.output:
-            self._raw_write(' '*(len(self._progress_msg[:self.width - 3]) + 2) + "\r")
+            if self._drawn_rows:
+                self._raw_write('\r\033[J')
+                self._drawn_rows = 0
+            else:
+                self._raw_write(' '*(len(self._drawn_msg)) + "\r")
+            self._drawn_msg = ''
+        # Draw the message again as soon as there is some progress
+        self._next_redraw = 0
 
 
+def _field(index):
+    "Property decoding a field of WvLine from its raw bytes on access"
+    def get(self):
+        return self.raw[self.spans[2*index]:self.spans[2*index+1]].decode(encoding, 'replace')
+    return property(get)
+
 class WvLine:
-    def __init__(self, match):
-        for (key, val) in match.groupdict().items():
-            setattr(self, key, val)
+    """Base class of wvtest protocol lines.
+
+    Lines are stored as raw bytes and offsets of their fields (spans),
+    which are decoded only when needed. This way, lines that are only
+    counted or discarded never allocate any strings.
+    """
+    __slots__ = ('raw', 'spans')
+
+    # Names of the fields (regular expression groups) in spans
+    fields = ()
+
+    @classmethod
+    def fromRaw(cls, raw: bytes, spans=()):
+        self = cls.__new__(cls)
+        self.raw = raw
+        self.spans = spans
+        return self
+
+    def _setParts(self, *parts):
+        """Set raw bytes from parts - alternating literal text and the
+        values of the fields."""
+        raw = b''
+        spans = []
+        for (i, part) in enumerate(parts):
+            part = part.encode(encoding, 'surrogateescape')
+            if i % 2:
+                spans += (len(raw), len(raw) + len(part))
+            raw += part
+        self.raw = raw
+        self.spans = tuple(spans)
+
+    def is_empty(self):
+        return not self.raw
 
     def print(self, file=sys.stdout):
         "Print the line (terminal is expected on output)"
@@ -145,23 +253,27 @@ class WvLine:
 
 
 class WvPlainLine(WvLine):
-    re = re.compile("(?P<line>.*)")
+    __slots__ = ()
+    fields = ('line',)
+
+    @property
+    def line(self):
+        return self.raw.decode(encoding, 'replace')
 
     def __str__(self):
         return self.line
 
 class WvTestingLine(WvLine):
-    re = re.compile('(?P<prefix>' + re_prefix + ')Testing "(?P<what>.*)" in (?P<where>.*):$')
-
-    def __init__(self, *args):
-        if len(args) == 1:
-            WvLine.__init__(self, args[0])
-        elif len(args) == 2:
-            self.prefix = ''
-            self.what = args[0]
-            self.where = args[1]
-        else:
-            raise TypeError("WvTestingLine.__init__() takes at most 2 positional arguments")
+    __slots__ = ()
+    fields = ('prefix', 'what', 'where')
+    re_body = 'Testing "(?P<what>.*)" in (?P<where>.*):$'
+
+    prefix = _field(0)
+    what = _field(1)
+    where = _field(2)
+
+    def __init__(self, what, where):
+        self._setParts('', '', 'Testing "', what, '" in ', where, ':')
 
     def __str__(self):
         return '{self.prefix}Testing "{self.what}" in {self.where}:'.format(self=self)
@@ -176,24 +288,23 @@ class WvTestingLine(WvLine):
         return WvCheckLine('{self.where}  {self.what}'.format(self=self), result)
 
 class WvCheckLine(WvLine):
-    re = re.compile('(?P<prefix>' + re_prefix + ')!\s*(?P<text>.*?)\s+(?P<result>\S+)$')
-
-    def __init__(self, *args):
-        if len(args) == 1:
-            WvLine.__init__(self, args[0])
-        elif len(args) == 2:
-            self.prefix = ''
-            self.text = args[0].rstrip(' .')
-            self.result = args[1]
-        else:
-            raise TypeError("WvCheckLine.__init__() takes at most 2 positional arguments")
+    __slots__ = ()
+    fields = ('prefix', 'text', 'result')
+    re_body = '!\s*(?P<text>.*?)\s+(?P<result>\S+)$'
 
-    def __str__(self):
+    prefix = _field(0)
+    text = _field(1)
+    result = _field(2)
+
+    def __init__(self, text, result):
         # Result == None when printing progress message
-        return '{self.prefix}! {self.text} {result}'.format(self=self, result=(self.result or ''))
+        self._setParts('', '', '! ', text.rstrip(' .'), ' ', result or '')
+
+    def __str__(self):
+        return '{self.prefix}! {self.text} {self.result}'.format(self=self)
 
     def is_success(self):
-        return self.result == 'ok'
+        return self.raw[self.spans[4]:self.spans[5]] == b'ok'
 
     def formated(self, highlight=True, include_newlines=False, result_space=10):
         text = '{self.prefix}! {self.text} '.format(self=self)
@@ -223,11 +334,551 @@ class WvCheckLine(WvLine):
         text = '{self.prefix}! {self.text} '.format(self=self)
         print('{text:.<80} {result}'.format(text=text, result=self.result), file=file)
 
+class WvPerfLine(WvCheckLine):
+    """Check line with the result of a performance measurement
+
+      ! where  PERF: name value [units] [axis="axis"]  result
+
+    as understood by tools/wvperf2html.py. The value is None if it is
+    not a number."""
+    __slots__ = ('name', 'value', 'units', 'axis')
+
+    re_perf = re.compile(r'(?:^|\s)PERF:\s*(\S+)(?:\s+(\S+))?(.*)')
+    re_axis = re.compile(r'axis="([^"]+)"')
+
+    @classmethod
+    def fromCheck(cls, check: WvCheckLine):
+        "Return WvPerfLine for a PERF check or the check itself."
+        match = cls.re_perf.search(check.text)
+        if not match:
+            return check
+        self = cls.fromRaw(check.raw, check.spans)
+        (self.name, value, rest) = match.groups()
+        try:
+            self.value = float(value)
+        except (TypeError, ValueError):
+            self.value = None
+        units = rest.split()[:1]
+        self.units = units[0] if units and '=' not in units[0] else None
+        axis = cls.re_axis.search(rest)
+        self.axis = axis.group(1) if axis else None
+        return self
 
 class WvTagLine(WvLine):
-    re  = re.compile('(?P<prefix>' + re_prefix + ')wvtest:\s*(?P<tag>.*)$')
+    __slots__ = ()
+    fields = ('prefix', 'tag')
+    re_body = 'wvtest:\s*(?P<tag>.*)$'
 
-class WvTestProcessor(list):
+    prefix = _field(0)
+    tag = _field(1)
+
+    def __str__(self):
+        return '{self.prefix}wvtest: {self.tag}'.format(self=self)
+
+class WvLineClassifier:
+    """Single-pass classifier of wvtest protocol lines.
+
+    It gives the same results as trying the regexes of WvCheckLine,
+    WvTestingLine, WvTagLine and WvPlainLine in turn, but it needs at
+    most one regular expression match per line. Lines that cannot be
+    protocol lines (they do not contain the literal text required by
+    any of the protocol regexes) are recognized without any regex at
+    all.
+    """
+
+    # Protocol line kinds in the order of their precedence
+    kinds = [WvCheckLine, WvTestingLine, WvTagLine]
+
+    # Literal text, which must follow the prefix in the line of a
+    # given kind
+    literals = (b'!', b'Testing "', b'wvtest:')
+
+    def __init__(self, prefix=None):
+        if prefix is None:
+            prefix = re_prefix
+        self.prefix = prefix
+
+        # Top-level alternatives are tried in order and each of
+        # them is fully backtracked before trying the next one, so
+        # the precedence of line kinds is preserved for any prefix.
+        alternatives = []
+        for cls in self.kinds:
+            name = cls.__name__
+            body = re.sub(r'\(\?P<(\w+)>', r'(?P<' + name + r'_\1>', cls.re_body)
+            alternatives.append('(?P<{name}>(?P<{name}_prefix>{prefix}){body})'
+                                .format(name=name, prefix=prefix, body=body))
+        self.re = re.compile('|'.join(alternatives).encode())
+
+        # Group numbers of the fields of each kind (the prefix may
+        # contain capturing groups, so we cannot just count them)
+        self.groups = {}
+        for cls in self.kinds:
+            name = cls.__name__
+            self.groups[name] = (cls, operator.itemgetter(
+                *[self.re.groupindex[name + '_' + f] for f in cls.fields]))
+
+        if prefix == '':
+            # Protocol lines can be recognized by their beginning
+            self.mayBeProtocol = self._startsWithLiteral
+            self.protocolLines = self._startingWithLiteral
+
+    def mayBeProtocol(self, line: bytes) -> bool:
+        "Return False if the line cannot match any protocol regex."
+        return b'!' in line or b'Testing "' in line or b'wvtest:' in line
+
+    def protocolLines(self, lines: list) -> list:
+        """Return the lines, for which mayBeProtocol() is true (without
+        calling it for every line)."""
+        return [line for line in lines
+                if b'!' in line or b'Testing "' in line or b'wvtest:' in line]
+
+    def _startsWithLiteral(self, line: bytes) -> bool:
+        return line.startswith(self.literals)
+
+    def _startingWithLiteral(self, lines: list) -> list:
+        literals = self.literals
+        return [line for line in lines if line.startswith(literals)]
+
+    def classify(self, line: bytes) -> WvLine:
+        """Return WvLine subclass instance representing the line. The
+        line is expected to be stripped of the trailing newline."""
+        if self.mayBeProtocol(line):
+            match = self.re.match(line)
+            if match:
+                (cls, groups) = self.groups[match.lastgroup]
+                entry = cls.fromRaw(line, sum(groups(match.regs), ()))
+                if cls is WvCheckLine and b'PERF:' in line:
+                    return WvPerfLine.fromCheck(entry)
+                return entry
+        return WvPlainLine.fromRaw(line)
+
+class WvSectionBuffer:
+    """Lines of the current "Testing" section with bounded memory usage.
+
+    At most max_lines lines are kept in memory - the first half of
+    them (head) in a list and the second half (tail) in a ring
+    buffer. Lines falling out of the ring buffer are spilled to a
+    temporary file, from which they are re-read when the section is
+    iterated. This way, no line is lost, but the memory usage does not
+    depend on the length of the section.
+
+    Every spilled line is stored with its kind and spans, so it is read
+    back exactly as it was, even if it came from the binary protocol
+    and would be classified differently as text. The record is a
+    header (kind, number of spans, length of raw bytes), the spans and
+    the raw bytes.
+    """
+
+    kinds = (WvPlainLine, WvCheckLine, WvPerfLine, WvTestingLine, WvTagLine)
+    record = struct.Struct('<BBI')
+
+    def __init__(self, max_lines=None):
+        if max_lines is None:
+            self.head_max = math.inf
+            self.tail_max = 0
+        else:
+            self.head_max = max_lines // 2
+            self.tail_max = max_lines - self.head_max
+        self.head = []
+        self.tail = collections.deque()
+        self.spill = None
+        self.spilled = 0
+
+    def append(self, entry: WvLine):
+        if len(self.head) < self.head_max:
+            self.head.append(entry)
+            return
+        if len(self.tail) >= self.tail_max:
+            if self.spill is None:
+                self.spill = tempfile.TemporaryFile()
+            if self.tail_max == 0:
+                old = entry
+            else:
+                old = self.tail.popleft()
+                self.tail.append(entry)
+            self.spill.write(self.record.pack(self.kinds.index(type(old)), len(old.spans), len(old.raw)) +
+                             struct.pack('<{}I'.format(len(old.spans)), *old.spans) + old.raw)
+            self.spilled += 1
+        else:
+            self.tail.append(entry)
+
+    def __iter__(self):
+        yield from self.head
+        if self.spill is not None:
+            self.spill.flush()
+            self.spill.seek(0)
+            for i in range(self.spilled):
+                (kind, nspans, length) = self.record.unpack(self.spill.read(self.record.size))
+                spans = struct.unpack('<{}I'.format(nspans), self.spill.read(4 * nspans))
+                raw = self.spill.read(length)
+                if self.kinds[kind] == WvPerfLine:
+                    yield WvPerfLine.fromCheck(WvCheckLine.fromRaw(raw, spans))
+                else:
+                    yield self.kinds[kind].fromRaw(raw, spans)
+            self.spill.seek(0, io.SEEK_END)
+        yield from self.tail
+
+    def __len__(self):
+        return len(self.head) + self.spilled + len(self.tail)
+
+    def moveSpill(self, filename):
+        """Spill lines to the named file instead of a temporary one, so
+        that they are pickled only by reference (see WvCheckpoint)."""
+        if self.spill is None or getattr(self.spill, 'name', None) == filename:
+            return
+        spill = open(filename, 'w+b')
+        self.spill.seek(0)
+        shutil.copyfileobj(self.spill, spill)
+        self.spill.close()
+        self.spill = spill
+
+    def __getstate__(self):
+        # Lines spilled to a named file (see moveSpill()) are pickled
+        # as its name and size, which are valid until the file is
+        # written again. Otherwise, they are pickled with their content.
+        state = self.__dict__.copy()
+        if self.spill is not None:
+            self.spill.flush()
+            if isinstance(getattr(self.spill, 'name', None), str):
+                state['spill'] = (self.spill.name, self.spill.tell())
+            else:
+                self.spill.seek(0)
+                state['spill'] = io.BytesIO(self.spill.read())
+                state['spill'].seek(0, io.SEEK_END)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.spill, tuple):
+            (filename, size) = self.spill
+            self.spill = open(filename, 'r+b')
+            # Drop lines spilled after the state was pickled
+            self.spill.truncate(size)
+            self.spill.seek(size)
+
+    def clear(self):
+        self.head = []
+        self.tail.clear()
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.spilled = 0
+
+class WvLogArchive:
+    """Logs of all "Testing" sections stored in a single append-only
+    file instead of a file per section (--logdir). If compressed, each
+    section is a separate gzip member, so that the whole file can also
+    be read by zcat. The index (FILE.idx) has one JSON object per line
+    describing a section: its number, log name (as in --logdir),
+    result, and the offset and length of its log in the file. A log of
+    a section can be read without reading the rest of the file."""
+
+    def __init__(self, file, index=None, compress=False):
+        self.file = file
+        self.index = index
+        self.compress = compress
+        self.count = 0
+        # Entries not written to the index (forked or loaded archives)
+        self.entries = []
+
+    @classmethod
+    def create(cls, filename):
+        return cls(open(filename, 'wb'),
+                   index=open(filename + '.idx', 'w', encoding='utf-8'),
+                   compress=filename.endswith('.gz'))
+
+    @classmethod
+    def load(cls, filename):
+        archive = cls(open(filename, 'rb'))
+        with open(filename + '.idx', encoding='utf-8') as f:
+            # The last line may be incomplete if wvtool was killed
+            archive.entries = [json.loads(line) for line in f if line.endswith('\n')]
+        archive.count = len(archive.entries)
+        return archive
+
+    def fork(self):
+        return WvLogArchive(tempfile.TemporaryFile(), compress=self.compress)
+
+    def __getstate__(self):
+        # Forked archives are pickled with their content (see
+        # WvTestProcessor.__getstate__)
+        state = self.__dict__.copy()
+        self.file.seek(0)
+        state['file'] = io.BytesIO(self.file.read())
+        return state
+
+    def _addEntry(self, entry):
+        self.count += 1
+        entry['id'] = self.count
+        if self.index:
+            self.index.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.file.flush()
+            self.index.flush()
+        else:
+            self.entries.append(entry)
+
+    def openSection(self, testing, name):
+        "Return a text stream for the log of a new section."
+        self.start = self.file.tell()
+        self.section = dict(where=testing.where, what=testing.what, name=name)
+        if self.compress:
+            raw = gzip.GzipFile(filename=name, mode='wb', fileobj=self.file)
+        else:
+            raw = self.file
+        return io.TextIOWrapper(raw, encoding=encoding, errors='surrogateescape')
+
+    def closeSection(self, log, failed):
+        raw = log.detach()
+        if raw is not self.file:
+            raw.close()         # Does not close self.file
+        self.section.update(result='FAILED' if failed else 'ok',
+                            offset=self.start,
+                            length=self.file.tell() - self.start,
+                            gzip=self.compress)
+        self._addEntry(self.section)
+
+    def merge(self, other):
+        "Append all sections of a forked or loaded archive."
+        base = self.file.tell()
+        other.file.seek(0)
+        shutil.copyfileobj(other.file, self.file)
+        other.file.close()
+        for entry in other.entries:
+            entry['offset'] += base
+            self._addEntry(entry)
+
+    def read(self, entry):
+        "Return the log of the section described by the index entry (bytes)."
+        self.file.seek(entry['offset'])
+        data = self.file.read(entry['length'])
+        return gzip.decompress(data) if entry['gzip'] else data
+
+    def close(self):
+        self.file.close()
+        if self.index:
+            self.index.close()
+
+class WvHistory:
+    """Results of runs stored in an SQLite database (--history): every
+    run, command (with its exit code), "Testing" section and check.
+    Rows are collected in memory and written in batches, each in a
+    single transaction, after every command or when batch_size rows
+    are pending. Forked histories (without a database) only collect
+    rows until they are merged."""
+
+    batch_size = 10000
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY, started REAL, argv TEXT,
+        tests INTEGER, failures INTEGER, duration REAL);
+    CREATE TABLE IF NOT EXISTS commands (
+        run INTEGER, seq INTEGER, command TEXT, exit_code INTEGER,
+        duration REAL, cached INTEGER);
+    CREATE TABLE IF NOT EXISTS sections (
+        run INTEGER, seq INTEGER, name TEXT, failed INTEGER,
+        checks INTEGER, failed_checks INTEGER, started REAL, duration REAL,
+        PRIMARY KEY (run, seq));
+    CREATE TABLE IF NOT EXISTS checks (
+        run INTEGER, section INTEGER, text TEXT, result TEXT);
+    CREATE INDEX IF NOT EXISTS sections_name ON sections (name, run);
+    CREATE INDEX IF NOT EXISTS sections_failed ON sections (run, name) WHERE failed;
+    CREATE INDEX IF NOT EXISTS checks_section ON checks (run, section);
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.run = None
+        self.commandCount = 0
+        self.commands = []
+        self.sections = []
+        self.checks = []
+
+    @classmethod
+    def open(cls, filename, readonly=False):
+        global sqlite3
+        import sqlite3
+        db = sqlite3.connect(filename)
+        # Also adds indexes missing in databases of older versions
+        db.executescript(cls.schema)
+        history = cls(db)
+        if not readonly:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            history.started = time.time()
+            with db:
+                history.run = db.execute('INSERT INTO runs (started, argv) VALUES (?, ?)',
+                                         (history.started, ' '.join(sys.argv))).lastrowid
+        return history
+
+    def fork(self):
+        return WvHistory()
+
+    def addCheck(self, section, check: WvCheckLine):
+        self.checks.append((self.run, section, check.text, check.result))
+        if self.db and len(self.checks) >= self.batch_size:
+            self.flush()
+
+    def addSection(self, section, name, failed, checks, failedChecks, started, duration):
+        self.sections.append((self.run, section, name, int(failed), checks, failedChecks,
+                              started, duration))
+
+    def addCommand(self, child):
+        self.commandCount += 1
+        self.commands.append((self.run, self.commandCount, child.cmd, child.exitCode,
+                              child.duration, int(isinstance(child, WvCachedChild))))
+        if self.db:
+            self.flush()
+
+    def merge(self, forked, sectionOffset):
+        "Add the rows of a forked history, renumbering its sections."
+        self.sections.extend((self.run, row[1] + sectionOffset) + row[2:]
+                             for row in forked.sections)
+        self.checks.extend((self.run, row[1] + sectionOffset) + row[2:]
+                           for row in forked.checks)
+
+    def flush(self):
+        with self.db:
+            self.db.executemany('INSERT INTO commands VALUES (?, ?, ?, ?, ?, ?)', self.commands)
+            self.db.executemany('INSERT INTO sections VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self.sections)
+            self.db.executemany('INSERT INTO checks VALUES (?, ?, ?, ?)', self.checks)
+        self.commands = []
+        self.sections = []
+        self.checks = []
+
+    def close(self, tests, failures):
+        self.flush()
+        with self.db:
+            self.db.execute('UPDATE runs SET tests = ?, failures = ?, duration = ? WHERE id = ?',
+                            (tests, failures, time.time() - self.started, self.run))
+        self.db.close()
+
+    # Queries of the history sub-command. They return lists of rows.
+
+    def lastRuns(self, count):
+        return self.db.execute('SELECT id, started, tests, failures, duration, argv FROM runs '
+                               'ORDER BY id DESC LIMIT ?', (count,)).fetchall()
+
+    def failingSince(self, pattern):
+        """Return (name, first run of the current failure streak, its start
+        time, number of failed runs) for sections matching pattern that
+        failed in their last run."""
+        result = []
+        # Only sections that ever failed are candidates (sections_failed index)
+        names = [name for (name,) in self.db.execute(
+            'SELECT DISTINCT name FROM sections INDEXED BY sections_failed '
+            'WHERE failed AND name GLOB ?', (pattern,))]
+        for name in names:
+            since = None
+            count = 0
+            for (run, failed) in self.db.execute(
+                    'SELECT run, failed FROM sections WHERE name = ? ORDER BY run DESC', (name,)):
+                if not failed:
+                    break
+                if run != since:
+                    count += 1
+                since = run
+            if since is not None:
+                (started,) = self.db.execute('SELECT started FROM runs WHERE id = ?',
+                                             (since,)).fetchone()
+                result.append((name, since, started, count))
+        return sorted(result, key=lambda r: r[1])
+
+    def flakiest(self, runs, count):
+        """Return (name, number of result changes, number of runs) of
+        sections whose result changed most often in the last runs."""
+        # Only sections that failed in these runs are candidates
+        return self.db.execute("""
+            WITH first(run) AS (SELECT MIN(id) FROM (SELECT id FROM runs ORDER BY id DESC LIMIT ?))
+            SELECT name, SUM(flip), COUNT(*) FROM (
+                SELECT name, failed != LAG(failed) OVER (PARTITION BY name ORDER BY run, seq) AS flip
+                FROM sections WHERE run >= (SELECT run FROM first) AND name IN (
+                    SELECT name FROM sections WHERE failed AND run >= (SELECT run FROM first)))
+            GROUP BY name HAVING SUM(flip) > 0 ORDER BY SUM(flip) DESC, name LIMIT ?""",
+                               (runs, count)).fetchall()
+
+    def durations(self, pattern, count):
+        """Return (name, run, start time, duration, failed) of the last
+        count runs of sections matching pattern, the oldest first."""
+        return self.db.execute("""
+            SELECT * FROM (SELECT name, run, started, duration, failed FROM sections
+                           WHERE name GLOB ? ORDER BY run DESC, seq DESC LIMIT ?)
+            ORDER BY run, name""", (pattern, count)).fetchall()
+
+class WvEvents:
+    """Stream of events seen by WvTestProcessor written as NDJSON
+    (--events): one JSON object per line for the start and the end of
+    every "Testing" section, checks, tags and exits of commands. The
+    events are buffered and written when a section ends or a command
+    exits, so that the file can be followed by other tools.
+
+    The JSON objects are formatted directly rather than with
+    json.dumps(), which would be the most expensive part of processing
+    a check. Forked streams keep their events as (name, section, the
+    rest of the object) until they are merged and their sections are
+    renumbered."""
+
+    def __init__(self, file=None):
+        self.file = file
+        self.events = []
+
+    def fork(self):
+        return WvEvents()
+
+    _str = staticmethod(json.encoder.encode_basestring_ascii)
+
+    def _add(self, name, section, rest):
+        if self.file:
+            self.events.append('{"event":"' + name + '","section":' + str(section) + rest + '}\n')
+        else:
+            self.events.append((name, section, rest))
+
+    def start(self, section, testing: WvTestingLine, time):
+        self._add('start', section, ',"where":{},"what":{},"time":{:.6f}'.format(
+            self._str(testing.where), self._str(testing.what), time))
+
+    def end(self, section, failed, checks, failedChecks, duration):
+        self._add('end', section, ',"result":"{}","checks":{},"failed":{},"duration":{:.6f}'.format(
+            'FAILED' if failed else 'ok', checks, failedChecks, duration))
+        self.flush()
+
+    def check(self, section, check: WvCheckLine):
+        # Fields are decoded here without WvCheckLine properties for speed
+        (raw, spans) = (check.raw, check.spans)
+        text = self._str(raw[spans[2]:spans[3]].decode(encoding, 'replace'))
+        if check.is_success():
+            self._add('check', section, ',"text":' + text + ',"result":"ok"')
+        else:
+            self._add('check', section, ',"text":' + text + ',"result":' +
+                      self._str(raw[spans[4]:spans[5]].decode(encoding, 'replace')))
+
+    def tag(self, section, tag: WvTagLine):
+        self._add('tag', section, ',"tag":' + self._str(tag.tag))
+
+    def exit(self, child):
+        self.events.append('{{"event":"exit","command":{},"code":{},"duration":{},"cached":{}}}\n'.format(
+            self._str(child.cmd), child.exitCode,
+            'null' if child.duration is None else '{:.6f}'.format(child.duration),
+            'true' if isinstance(child, WvCachedChild) else 'false'))
+        self.flush()
+
+    def done(self, tests, failures):
+        self.events.append('{{"event":"done","tests":{},"failures":{}}}\n'.format(tests, failures))
+        self.flush()
+
+    def merge(self, forked, sectionOffset):
+        "Add the events of a forked stream, renumbering its sections."
+        for (name, section, rest) in forked.events:
+            self._add(name, section + sectionOffset, rest)
+        self.flush()
+
+    def flush(self):
+        if self.file and self.events:
+            self.file.write(''.join(self.events))
+            self.file.flush()
+            self.events = []
+
+class WvTestProcessor:
 
     class Verbosity:
         # Print one line for each "Testing" section. Passed tests are
@@ -246,7 +897,15 @@ class WvTestProcessor(list):
                  verbosity = Verbosity.NORMAL,
                  junit_xml: io.IOBase = None,
                  junit_prefix: str = '',
-                 logdir = None):
+                 logdir = None,
+                 max_buffered_lines = None,
+                 output = sys.stdout,
+                 junit_document = True,
+                 log_archive: WvLogArchive = None,
+                 history: WvHistory = None,
+                 events: WvEvents = None,
+                 durations = 0,
+                 perf = None):
         self.checkCount = 0
         self.checkFailedCount = 0
         self.testCount = 0
@@ -254,9 +913,47 @@ class WvTestProcessor(list):
 
         self.implicitTestTitle = None
         self.currentTest = None
+        # The current section is continued by the next run (suspend())
+        self.suspended = False
+
+        # (section name, duration) of finished sections
+        self.sectionDurations = []
+
+        # Monotonic time of the start of processing and of the start of
+        # the current check (i.e. the end of the previous one)
+        self.startTime = self.checkStart = time.monotonic()
+
+        # Min-heap of (duration, section name, check) of the slowest
+        # checks for the durations report
+        self.durations = durations
+        self.slowestChecks = []
+
+        # Samples of PERF checks of the current section (name -> (values,
+        # units)) aggregated and compared with the baseline by perf
+        # (WvPerf)
+        self.perf = perf
+        self.perfSamples = {}
+
+        # Time given by "wvtest: timestamp" tag lines (e.g. from binary
+        # protocol). It is forgotten at the start of a section unless
+        # it was given right before it (only tags may be in between), so
+        # that a section started by a text line after binary frames
+        # does not get the time of the last frame.
+        self.timestamp = None
+        self.timestampFresh = False
+
+        # Timeouts declared by "wvtest:" tag lines
+        self.inactivityTimeout = None
+        self.sectionTimeout = None
+        self.sectionDeadline = None
 
         self.verbosity = verbosity
         self.show_progress = False
+        self.output = output
+
+        self.classifier = WvLineClassifier()
+        self.max_buffered_lines = max_buffered_lines
+        self.lines = WvSectionBuffer(max_buffered_lines)
 
         self.junit_xml = junit_xml
         self.junit_prefix = junit_prefix
@@ -265,25 +962,33 @@ class WvTestProcessor(list):
             global wvjunit
             import wvjunit
             self.junitTestcases = []
-            self.junitTestsuites = []
+            self.junitWriter = wvjunit.Writer(junit_xml, document=junit_document)
 
         self.logdir = logdir
         self.log = None
+        self.logFiles = []
         if logdir and not os.path.isdir(logdir):
             os.mkdir(logdir)
+        self.logArchive = log_archive
+        self.history = history
+        self.events = events
+
+        # Lines of the current section are only needed for printing
+        # failed sections and for JUnit system-out.
+        self.retain_lines = (verbosity == self.Verbosity.NORMAL or bool(junit_xml))
 
     def setImplicitTestTitle (self, testing):
         """If the test does not supply its own title as the first line of test
         output, this title will be used instead."""
         self.implicitTestTitle = testing
 
-    def print(self, file=sys.stdout):
-        for entry in self:
-            entry.print(file=file)
+    def print(self, file=None):
+        for entry in self.lines:
+            entry.print(file=file or self.output)
 
     def __str__(self):
         s = ''
-        for entry in self:
+        for entry in self.lines:
             if 'formated' in dir(entry):
                 e = entry.formated()
             else:
@@ -292,14 +997,15 @@ class WvTestProcessor(list):
         return s
 
     def plainText(self):
-        return "\n".join([str(entry) for entry in self]) + "\n"
+        return "\n".join([str(entry) for entry in self.lines]) + "\n"
 
     def _rememberJUnitTestcase(self, check: WvCheckLine):
         if not self.junit_xml:
             return
 
-        t = time.time()
-        duration = t - (self.lastCheckTime or self.testStartTime)
+        t = self.now()
+        # Timestamps of the test and our time may differ slightly
+        duration = max(t - (self.lastCheckTime or self.testStartTime), 0)
         self.lastCheckTime = t
 
         if not check.is_success():
@@ -318,11 +1024,21 @@ class WvTestProcessor(list):
                 time=duration,
                 failure=failure))
 
+    _hostname = None
+
+    @classmethod
+    def hostname(cls):
+        # getfqdn() may query DNS, so it is called only once
+        if cls._hostname is None:
+            cls._hostname = socket.getfqdn()
+        return cls._hostname
+
     def _rememberJUnitTestsuite(self):
         if not self.junit_xml:
             return
 
-        system_out = wvjunit.SystemOut(text=self.plainText())
+        # Stream the lines (possibly spilled to disk) to the file
+        system_out = wvjunit.SystemOutStream(str(entry) for entry in self.lines)
 
         ts = wvjunit.Testsuite(tests=self.checkCount,
                                failures=self.checkFailedCount,
@@ -331,89 +1047,174 @@ class WvTestProcessor(list):
                                    self.junit_prefix,
                                    self.currentTest.where.replace('.', '_'),
                                    self.currentTest.what),
-                               time=time.time()-self.testStartTime,
-                               hostname=socket.getfqdn(),
-                               timestamp=datetime.datetime.now(),
+                               time=max(self.now()-self.testStartTime, 0),
+                               hostname=self.hostname(),
+                               timestamp=datetime.datetime.fromtimestamp(self.now()),
                                testcases=self.junitTestcases,
                                system_out=system_out)
-        self.junitTestsuites.append(ts)
+        self.junitWriter.write(ts)
         self.junitTestcases = []
 
     def _generateJUnitXML(self):
         if not self.junit_xml:
             return
-        tss = wvjunit.Testsuites(testsuites=self.junitTestsuites)
-        tss.print(file=self.junit_xml)
+        self.junitWriter.close()
+
+    def _sectionName(self):
+        return self.currentTest.asWvCheckLine(None).text
 
     def _finishCurrentTest(self):
+        if self.perf:
+            # Regressions are reported as failed checks of the section
+            for text in self.perf.finishSection(self._sectionName(), self.perfSamples):
+                self._appendToSection(WvCheckLine(self.currentTest.where + '  ' + text, 'FAILED'))
+            self.perfSamples = {}
         self._rememberJUnitTestsuite()
+        name = self._sectionName()
+        duration = time.monotonic() - self.sectionStart
+        self.sectionDurations.append((name, duration))
+        if self.history:
+            self.history.addSection(self.testCount, name, self.checkFailedCount > 0,
+                                    self.checkCount, self.checkFailedCount,
+                                    self.testStartTime, duration)
+        if self.events:
+            self.events.end(self.testCount, self.checkFailedCount > 0,
+                            self.checkCount, self.checkFailedCount, duration)
         if self.checkFailedCount > 0:
             if self.show_progress and self.verbosity < self.Verbosity.VERBOSE:
                 term.clear_progress_msg()
             if self.verbosity == self.Verbosity.NORMAL:
                 self.print()
             elif self.verbosity < self.Verbosity.NORMAL:
-                self.currentTest.asWvCheckLine('FAILED').print()
+                self.currentTest.asWvCheckLine('FAILED').print(self.output)
             self.testFailedCount += 1
         else:
             if self.verbosity <= self.Verbosity.NORMAL:
-                self.currentTest.asWvCheckLine('ok').print()
-        sys.stdout.flush()
+                self.currentTest.asWvCheckLine('ok').print(self.output)
+        self.output.flush()
         self.clear()
         if self.log:
-            self.log.close()
+            if self.logArchive:
+                self.logArchive.closeSection(self.log, self.checkFailedCount > 0)
+            else:
+                self.log.close()
+            self.log = None
 
     def clear(self):
-        del self[:]
+        self.lines.clear()
 
     def _newTest(self, testing : WvTestingLine):
         if self.currentTest:
             self._finishCurrentTest()
+        if not self.timestampFresh:
+            self.timestamp = None
+        self.timestampFresh = False
         if testing != None:
             self.testCount += 1
             if self.show_progress and self.verbosity < self.Verbosity.VERBOSE:
                 term.set_progress_msg(str(testing.asWvCheckLine(None)))
 
-            if self.logdir:
+            if self.logdir or self.logArchive:
                 trans = str.maketrans(' /', '__')
-                self.log = open(os.path.join(self.logdir, "%04d-%s-%s.log" %
-                                             (self.testCount,
-                                              testing.where.translate(trans),
-                                              testing.what.lower().translate(trans))),
-                                'w')
-            self.testStartTime = time.time()
+                name = "%s-%s.log" % (testing.where.translate(trans),
+                                      testing.what.lower().translate(trans))
+            if self.logdir:
+                self.logFiles.append(name)
+                self.log = open(os.path.join(self.logdir, "%04d-%s" % (self.testCount, name)), 'w')
+            elif self.logArchive:
+                self.log = self.logArchive.openSection(testing, name)
+            self.testStartTime = self.now()
+            self.sectionStart = self.checkStart = time.monotonic()
             self.lastCheckTime = None
+            if self.events:
+                self.events.start(self.testCount, testing, self.testStartTime)
         self.currentTest = testing
         self.checkCount = 0
         self.checkFailedCount = 0
+        self.sectionTimeout = None
+        self.sectionDeadline = None
+
+    re_timeout_tag = re.compile(r'(section\s+)?timeout\s+(\d+(?:\.\d*)?)\s*$')
+    re_timestamp_tag = re.compile(r'timestamp\s+(\d+(?:\.\d*)?)\s*$')
+
+    def now(self):
+        """Return the time of the output being processed - the last
+        "wvtest: timestamp" tag if any, the current time otherwise."""
+        return self.timestamp if self.timestamp is not None else time.time()
+
+    def _newTag(self, tag: WvTagLine):
+        if self.events:
+            self.events.tag(self.testCount, tag)
+        match = self.re_timestamp_tag.match(tag.tag)
+        if match:
+            self.timestamp = float(match.group(1))
+            self.timestampFresh = True
+            return
+        match = self.re_timeout_tag.match(tag.tag)
+        if match:
+            timeout = float(match.group(2))
+            if match.group(1):
+                # The rest of the section must finish in time
+                self.sectionTimeout = timeout
+                self.sectionDeadline = time.monotonic() + timeout
+            else:
+                # Change of the timeout for any output
+                self.inactivityTimeout = timeout
+
+    def _newPerf(self, perf: WvPerfLine):
+        if self.perf and perf.value is not None and perf.is_success():
+            self.perfSamples.setdefault(perf.name, ([], perf.units))[0].append(perf.value)
 
     def _newCheck(self, check: WvCheckLine):
+        t = time.monotonic()
+        duration = t - self.checkStart
+        self.checkStart = t
+        if self.durations:
+            if len(self.slowestChecks) < self.durations:
+                heapq.heappush(self.slowestChecks, (duration, self._sectionName(), check.text))
+            elif duration > self.slowestChecks[0][0]:
+                heapq.heapreplace(self.slowestChecks, (duration, self._sectionName(), check.text))
         self.checkCount += 1
         if not check.is_success():
             self.checkFailedCount += 1
         self._rememberJUnitTestcase(check)
+        if self.history:
+            self.history.addCheck(self.testCount, check)
+        if self.events:
+            self.events.check(self.testCount, check)
 
     def append(self, logEntry: WvLine):
         if self.implicitTestTitle:
-            if str(logEntry) == '':
+            if logEntry.is_empty():
                 pass
             elif type(logEntry) != WvTestingLine:
                 self._newTest(self.implicitTestTitle)
-                super().append(self.implicitTestTitle)
+                if self.retain_lines:
+                    self.lines.append(self.implicitTestTitle)
                 self.implicitTestTitle = None
             else:
                 self.implicitTestTitle = None
+        if type(logEntry) not in (WvTestingLine, WvTagLine):
+            self.timestampFresh = False
+        self._appendToSection(logEntry)
 
-
+    def _appendToSection(self, logEntry: WvLine):
+        "Process the line as a part of the current section."
         if type(logEntry) == WvTestingLine:
             self._newTest(logEntry)
         elif type(logEntry) == WvCheckLine:
             self._newCheck(logEntry)
+        elif type(logEntry) == WvTagLine:
+            self._newTag(logEntry)
+        elif type(logEntry) == WvPerfLine:
+            self._newPerf(logEntry)
+            self._newCheck(logEntry)
 
-        list.append(self, logEntry)
+        if self.retain_lines:
+            self.lines.append(logEntry)
 
         if self.verbosity == self.Verbosity.VERBOSE:
-            logEntry.print()
+            logEntry.print(self.output)
         else:
             if self.show_progress:
                 term.update_progress_msg()
@@ -422,95 +1223,1415 @@ class WvTestProcessor(list):
             logEntry.log(self.log)
 
     def processLine(self, line):
-        line = line.rstrip()
-        logEntry = None
-
-        for lineClass in [ WvCheckLine, WvTestingLine, WvTagLine, WvPlainLine ]:
-            match = lineClass.re.match(line)
-            if match:
-                logEntry = lineClass(match)
-                break
-        if not logEntry:
-            raise Exception("Non-matched line: {}".format(line))
+        if isinstance(line, str):
+            line = line.encode(encoding, 'surrogateescape')
+        self.append(self.classifier.classify(line.rstrip()))
+
+    def needsPlainLines(self):
+        "Return True if plain (non-protocol) lines have any effect."
+        return (self.implicitTestTitle is not None or self.retain_lines or
+                self.verbosity == self.Verbosity.VERBOSE or self.log is not None)
+
+    def processLines(self, lines):
+        """Process a batch of lines (bytes). Plain lines are skipped
+        without any processing if they are not needed."""
+        if not self.needsPlainLines():
+            lines = self.classifier.protocolLines(lines)
+            if self.show_progress:
+                term.update_progress_msg()
+        self.processProtocolLines(lines)
+
+    def processProtocolLines(self, lines):
+        """Process a batch of lines (bytes) like processLine(), without
+        skipping any of them."""
+        classify = self.classifier.classify
+        append = self.append
+        for line in lines:
+            append(classify(line.rstrip()))
+
+    def appendLines(self, lines):
+        """Process a batch of already classified lines (WvLine). Plain
+        lines are skipped if they are not needed."""
+        if not self.needsPlainLines():
+            lines = [line for line in lines if type(line) != WvPlainLine]
+            if self.show_progress:
+                term.update_progress_msg()
+        for line in lines:
+            self.append(line)
+
+    def __getstate__(self):
+        """Finished forked processors are pickled to be merged in another
+        process (format -j). Temporary files are replaced by their
+        content."""
+        state = self.__dict__.copy()
+        if self.junit_xml:
+            self.junit_xml.seek(0)
+            state['junit_xml'] = io.StringIO(self.junit_xml.read())
+            state['junitWriter'] = None
+        return state
+
+    def fork(self):
+        """Return a new processor with the same settings for processing
+        the output of one of concurrently running commands. Its output
+        is buffered and its results are added to this processor by
+        merge()."""
+        return WvTestProcessor(
+            self.verbosity,
+            junit_xml = tempfile.TemporaryFile('w+', encoding='utf-8') if self.junit_xml else None,
+            junit_prefix = self.junit_prefix,
+            logdir = tempfile.mkdtemp(prefix='.', dir=self.logdir) if self.logdir else None,
+            max_buffered_lines = self.max_buffered_lines,
+            output = io.StringIO(),
+            junit_document = False,
+            log_archive = self.logArchive.fork() if self.logArchive else None,
+            history = self.history.fork() if self.history else None,
+            events = self.events.fork() if self.events else None,
+            durations = self.durations,
+            perf = self.perf.fork() if self.perf else None)
+
+    def merge(self, forked):
+        """Add the results of a finished forked processor to this one as
+        if its output was processed here."""
+        forked.finish()
+        self._newTest(None)
+        self.output.write(forked.output.getvalue())
+        self.output.flush()
+        if self.logdir:
+            for (num, name) in enumerate(forked.logFiles, 1):
+                os.rename(os.path.join(forked.logdir, "%04d-%s" % (num, name)),
+                          os.path.join(self.logdir, "%04d-%s" % (self.testCount + num, name)))
+            os.rmdir(forked.logdir)
+            self.logFiles.extend(forked.logFiles)
+        if self.logArchive:
+            self.logArchive.merge(forked.logArchive)
+        if self.history:
+            self.history.merge(forked.history, self.testCount)
+        if self.events:
+            self.events.merge(forked.events, self.testCount)
+        if self.perf:
+            self.perf.merge(forked.perf)
+        if self.junit_xml:
+            forked.junit_xml.seek(0)
+            self.junitWriter.writeRaw(forked.junit_xml)
+            forked.junit_xml.close()
+        self.sectionDurations.extend(forked.sectionDurations)
+        for entry in forked.slowestChecks:
+            if len(self.slowestChecks) < self.durations:
+                heapq.heappush(self.slowestChecks, entry)
+            elif entry > self.slowestChecks[0]:
+                heapq.heapreplace(self.slowestChecks, entry)
+        self.testCount += forked.testCount
+        self.testFailedCount += forked.testFailedCount
+
+    def finish(self):
+        "Finish the last section."
+        self._newTest(None)
 
-        self.append(logEntry)
+    def suspend(self):
+        """Leave the last section unfinished at done(), because it is
+        continued by the next run from a checkpoint. It is neither
+        printed nor counted in the totals."""
+        self.suspended = True
+
+    # Attributes describing the progress of processing (as opposed to
+    # the settings)
+    _progress = ('checkCount', 'checkFailedCount', 'testCount', 'testFailedCount',
+                 'implicitTestTitle', 'currentTest', 'timestamp', 'timestampFresh', 'lines',
+                 'testStartTime', 'lastCheckTime', 'perfSamples')
+
+    def checkpoint(self):
+        """Return the state of processing to be restored by restore(),
+        possibly in another wvtool process with the same settings."""
+        return {name: getattr(self, name) for name in self._progress if hasattr(self, name)}
+
+    def restore(self, state):
+        self.__dict__.update(state)
+        if self.currentTest:
+            # Durations are only measured within one process
+            self.sectionStart = self.checkStart = time.monotonic()
+            self.lastCheckTime = None
 
     def done(self):
-        self._newTest(None)
+        testCount = self.testCount
+        if self.suspended and self.currentTest:
+            if self.show_progress and self.verbosity < self.Verbosity.VERBOSE:
+                term.clear_progress_msg()
+            print("WvTest: section {} is not finished yet, it is continued by the next run."
+                  .format(self._sectionName()), file=self.output)
+            testCount -= 1
+        else:
+            self.finish()
 
         self._generateJUnitXML()
+        if self.logArchive:
+            self.logArchive.close()
+        if self.history:
+            self.history.close(self.testCount, self.testFailedCount)
+        if self.events:
+            self.events.done(self.testCount, self.testFailedCount)
+        if self.perf:
+            self.perf.save()
+        if self.durations:
+            self._printDurations()
 
         print("WvTest: {total} test{plt}, {fail} failure{plf}."
-              .format(total = self.testCount, plt = '' if self.testCount == 1 else 's',
-                      fail = self.testFailedCount, plf = '' if self.testFailedCount  == 1 else 's'))
+              .format(total = testCount, plt = '' if testCount == 1 else 's',
+                      fail = self.testFailedCount, plf = '' if self.testFailedCount  == 1 else 's'),
+              file=self.output)
     def is_success(self):
         return self.testFailedCount == 0
 
-def _run(command, processor, timeout=100):
-    processor.show_progress = True
-
-
-    def kill_child(sig = None, frame = None):
-        os.killpg(proc.pid, sig)
-
-    def alarm(sig = None, frame = None):
-        msg = "! {wvtool}: Alarm timed out!  No test output for {timeout} seconds.  FAILED"
-        processor.processLine(msg.format(wvtool=sys.argv[0], timeout=timeout))
-        kill_child(signal.SIGTERM)
-
-    signal.signal(signal.SIGINT, kill_child)
-    signal.signal(signal.SIGTERM, kill_child)
-    signal.signal(signal.SIGALRM, alarm)
-
-    cmd = command if isinstance(command, str) else ' '.join(command)
-    processor.setImplicitTestTitle(WvTestingLine("Preamble of "+cmd, "wvtool"))
-
-    # Popen does not seem to be able to call setpgrp(). Therefore, we
-    # use start_new_session, but this also create a new session and
-    # detaches the process from a terminal. This might be a problem
-    # for programs that need a terminal to run.
-    with sp.Popen(command, stdin=None, stdout=sp.PIPE, stderr=sp.STDOUT,
-                  universal_newlines=False, start_new_session=True) as proc:
-        signal.alarm(timeout)
-        stdout = io.TextIOWrapper(proc.stdout, errors='replace')
-        for line in stdout:
-            signal.alarm(timeout)
-            processor.processLine(line)
-
-    signal.alarm(0)
-
-    if proc.returncode != 0:
-        if proc.returncode > 0:
-            msg = "{wvtool}: Program '{cmd}' returned non-zero exit code {ec}"
+    # Upper bounds (seconds) and labels of the buckets of the histogram
+    # of section durations
+    histogram = ((0.001, '< 1 ms'), (0.01, '< 10 ms'), (0.1, '< 100 ms'), (1, '< 1 s'),
+                 (10, '< 10 s'), (60, '< 1 min'), (600, '< 10 min'), (math.inf, '>= 10 min'))
+
+    def _printDurations(self):
+        "Print the slowest sections and checks and the histogram of section durations."
+        wall = time.monotonic() - self.startTime
+        out = self.output
+        print("Slowest sections:", file=out)
+        for (name, duration) in heapq.nlargest(self.durations, self.sectionDurations,
+                                               key=operator.itemgetter(1)):
+            print("{:10.3f} s  {}".format(duration, name), file=out)
+        print("Slowest checks:", file=out)
+        for (duration, name, text) in sorted(self.slowestChecks, reverse=True):
+            print("{:10.3f} s  {}: {}".format(duration, name, text), file=out)
+
+        print("Section durations:", file=out)
+        counts = [0] * len(self.histogram)
+        for (name, duration) in self.sectionDurations:
+            counts[next(i for (i, (limit, label)) in enumerate(self.histogram)
+                        if duration < limit)] += 1
+        scale = 40 / max(max(counts), 40)
+        # Skip empty buckets at both ends
+        used = [i for (i, count) in enumerate(counts) if count] or [0]
+        for i in range(used[0], used[-1] + 1):
+            (label, count) = (self.histogram[i][1], counts[i])
+            print("{:>12} {:6} {}".format(label, count, '#' * math.ceil(count * scale)), file=out)
+
+        total = sum(duration for (name, duration) in self.sectionDurations)
+        if total <= wall:
+            rest = "{:.3f} s outside of sections".format(wall - total)
+        else:
+            rest = "{:.1f} sections running in parallel on average".format(total / wall)
+        print("Total: {} sections took {:.3f} s, wall time {:.3f} s ({})"
+              .format(len(self.sectionDurations), total, wall, rest), file=out)
+
+class WvLineSplitter:
+    """Splits chunks of bytes read from a pipe to lines. As with text
+    files, lines may be terminated by '\\n', '\\r\\n' or '\\r'. Lines
+    longer than max_length bytes are split to max_length pieces so
+    that a child printing a lot of data without a newline cannot
+    exhaust our memory."""
+
+    def __init__(self, max_length=None):
+        self.max_length = max_length
+        self.pending = b''
+        self.skip_lf = False
+
+    def feed(self, data: bytes) -> list:
+        "Return the list of lines completed by data."
+        if self.skip_lf and data:
+            if data.startswith(b'\n'):
+                # Second half of '\r\n' split between chunks
+                data = data[1:]
+            self.skip_lf = False
+        if self.pending:
+            data = self.pending + data
+        if not data:
+            return []
+        lines = data.splitlines()
+        if data[-1] in b'\r\n':
+            self.pending = b''
+        else:
+            self.pending = lines.pop()
+        self.skip_lf = data.endswith(b'\r')
+        if self.max_length:
+            if any(len(line) > self.max_length for line in lines):
+                lines = [piece for line in lines for piece in self._cut(line)]
+            if len(self.pending) > self.max_length:
+                pieces = self._cut(self.pending)
+                self.pending = pieces.pop()
+                lines.extend(pieces)
+        return lines
+
+    def flush(self) -> list:
+        "Return the last unterminated line (if any)."
+        lines = [self.pending] if self.pending else []
+        self.pending = b''
+        return lines
+
+    def _cut(self, line):
+        m = self.max_length
+        return [line[i:i+m] for i in range(0, len(line), m)] or [line]
+
+class WvFrameDecoder:
+    """Decodes the binary framing of the wvtest protocol to WvLine
+    objects, which are the same as if the text protocol was parsed.
+
+    The stream starts with the magic bytes followed by frames. Every
+    frame is a type byte and a little-endian 32-bit length of the
+    payload, followed by the payload:
+
+      T  Testing: 32-bit length of "what", "what", "where"
+      C  check: 8-bit length of result, result, text of the check
+      G  tag: text of the tag (without "wvtest:")
+      O  raw output of the test (plain lines, possibly partial)
+      S  timestamp: seconds since the epoch as a little-endian double
+
+    Timestamps are converted to "wvtest: timestamp SECONDS" tags. If an
+    invalid frame is found, a failed check is reported and the rest of
+    the stream is available in self.rest to be processed as text."""
+
+    magic = b'\xffWvTest\x01\n'
+    header = struct.Struct('<BI')
+    kinds = b'TCGOS'
+
+    def __init__(self, max_line_length=None):
+        self.buf = b''
+        self.output = WvLineSplitter(max_line_length)
+        self.rest = None
+
+    def _outputLines(self, lines):
+        return [WvPlainLine.fromRaw(line.rstrip()) for line in lines]
+
+    def feed(self, data: bytes, output=True) -> list:
+        """Return the list of WvLines of all complete frames in data.
+        With output=False, raw output of the test is skipped."""
+        buf = self.buf + data if self.buf else data
+        pos = 0
+        end = len(buf)
+        lines = []
+        out = []                # Payloads of consecutive output frames
+        unpack = self.header.unpack_from
+        while pos + 5 <= end:
+            (kind, length) = unpack(buf, pos)
+            start = pos + 5
+            if kind == 0x4f:    # O
+                if start + length > end:
+                    break
+                if output:
+                    out.append(buf[start:start+length])
+                pos = start + length
+                continue
+            if kind not in self.kinds:
+                return self._invalid(lines, out, buf[pos:], kind)
+            if start + length > end:
+                break
+            # Other frames terminate unfinished output lines
+            if out:
+                lines.extend(self._outputLines(self.output.feed(b''.join(out))))
+                out = []
+            if self.output.pending:
+                lines.extend(self._outputLines(self.output.flush()))
+            pos = start + length
+            if kind == 0x43:    # C
+                rl = buf[start] if length else length
+                tl = length - 1 - rl
+                if tl < 0:
+                    return self._invalid(lines, out, buf[start-5:], kind)
+                check = WvCheckLine.fromRaw(b'! ' + buf[start+1+rl:pos] + b' ' + buf[start+1:start+1+rl],
+                                            (0, 0, 2, 2+tl, 3+tl, 3+tl+rl))
+                if b'PERF:' in check.raw:
+                    check = WvPerfLine.fromCheck(check)
+                lines.append(check)
+            elif kind == 0x54:  # T
+                wl = int.from_bytes(buf[start:start+4], 'little')
+                if length < 4 + wl:
+                    return self._invalid(lines, out, buf[start-5:], kind)
+                what = buf[start+4:start+4+wl]
+                where = buf[start+4+wl:pos]
+                lines.append(WvTestingLine.fromRaw(b'Testing "' + what + b'" in ' + where + b':',
+                                                   (0, 0, 9, 9+wl, 14+wl, 14+wl+len(where))))
+            elif kind == 0x47:  # G
+                lines.append(WvTagLine.fromRaw(b'wvtest: ' + buf[start:pos], (0, 0, 8, 8+length)))
+            else:               # S
+                if length != 8:
+                    return self._invalid(lines, out, buf[start-5:], kind)
+                tag = 'timestamp {:.6f}'.format(struct.unpack_from('<d', buf, start)[0]).encode()
+                lines.append(WvTagLine.fromRaw(b'wvtest: ' + tag, (0, 0, 8, 8+len(tag))))
+        if out:
+            lines.extend(self._outputLines(self.output.feed(b''.join(out))))
+        self.buf = buf[pos:]
+        return lines
+
+    def _invalid(self, lines, out, rest, kind):
+        if out:
+            lines.extend(self._outputLines(self.output.feed(b''.join(out))))
+        lines.append(WvCheckLine("{}: Invalid binary frame of type {}, the rest is processed as text"
+                                 .format(sys.argv[0], kind), 'FAILED'))
+        self.rest = rest
+        self.buf = b''
+        return lines
+
+    def flush(self) -> list:
+        "Return the last unfinished output line and report a truncated frame."
+        lines = self._outputLines(self.output.flush())
+        if self.buf:
+            lines.append(WvCheckLine("{}: Truncated binary frame at the end of output"
+                                     .format(sys.argv[0]), 'FAILED'))
+            self.buf = b''
+        return lines
+
+class WvInputDecoder:
+    """Feeds chunks of output of a test to a processor. The output is
+    either the text protocol or, if it starts with
+    WvFrameDecoder.magic, the binary one."""
+
+    def __init__(self, processor, max_line_length=None):
+        self.processor = processor
+        self.max_line_length = max_line_length
+        self.splitter = None
+        self.frames = None
+        self.head = b''
+
+    def feed(self, data: bytes):
+        if self.splitter:
+            self.processor.processLines(self.splitter.feed(data))
+        elif self.frames:
+            self.processor.appendLines(self.frames.feed(data, self.processor.needsPlainLines()))
+            if self.frames.rest is not None:
+                self._startText(self.frames.rest)
+        else:
+            # Detect the protocol from the beginning of the output
+            self.head += data
+            magic = WvFrameDecoder.magic
+            if self.head.startswith(magic):
+                self.frames = WvFrameDecoder(self.max_line_length)
+                data = self.head[len(magic):]
+                self.head = b''
+                self.feed(data)
+            elif len(self.head) >= len(magic) or not magic.startswith(self.head):
+                self._startText(self.head)
+
+    def _startText(self, data):
+        self.frames = None
+        self.head = b''
+        self.splitter = WvLineSplitter(self.max_line_length)
+        self.feed(data)
+
+    def flush(self):
+        if self.head:
+            self._startText(self.head)
+        if self.splitter:
+            self.processor.processLines(self.splitter.flush())
+        elif self.frames:
+            self.processor.appendLines(self.frames.flush())
+
+class WvChild:
+    """Supervised command, whose output is fed to a WvTestProcessor.
+
+    The child has several timers: inactivity timeout (no output for
+    the given time), total time of the command and the time of the
+    current section (declared by "wvtest: section timeout N" line).
+    When any of them expires, the process group of the command is
+    sent SIGTERM and, if it does not exit within kill_grace seconds,
+    SIGKILL."""
+
+    def __init__(self, command, processor, timeout=100, max_line_length=None,
+                 command_timeout=None, kill_grace=5, record=None):
+        self.command = command
+        self.record = record
+        self.cmd = command if isinstance(command, str) else ' '.join(command)
+        self.processor = processor
+        self.timeout = timeout
+        self.command_timeout = command_timeout
+        self.kill_grace = kill_grace
+        self.input = WvInputDecoder(processor, max_line_length)
+
+        processor.setImplicitTestTitle(WvTestingLine("Preamble of "+self.cmd, "wvtool"))
+        processor.inactivityTimeout = None
+        processor.timestamp = None
+        self.firstFailed = processor.testFailedCount
+
+        # Popen does not seem to be able to call setpgrp(). Therefore, we
+        # use start_new_session, but this also create a new session and
+        # detaches the process from a terminal. This might be a problem
+        # for programs that need a terminal to run.
+        self.proc = sp.Popen(command, stdin=None, stdout=sp.PIPE, stderr=sp.STDOUT,
+                             universal_newlines=False, start_new_session=True)
+        now = time.monotonic()
+        self.startTime = now
+        self.deadline = now + timeout
+        self.commandDeadline = now + command_timeout if command_timeout else math.inf
+        self.killDeadline = math.inf
+        self.terminating = False
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def kill(self, sig):
+        try:
+            os.killpg(self.proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def read(self):
+        """Read and process a chunk of the output. Return False at the
+        end of the output."""
+        # Read the output in big chunks and re-arm the timer only
+        # once per chunk rather than once per line.
+        data = os.read(self.fileno(), _read_size)
+        if not data:
+            return False
+        if self.record:
+            self.record.write(data)
+        self.input.feed(data)
+        self.deadline = time.monotonic() + (self.processor.inactivityTimeout or self.timeout)
+        return True
+
+    def nextDeadline(self):
+        "Return the time (time.monotonic()) when some timer expires."
+        if self.terminating:
+            return self.killDeadline
+        return min(self.deadline, self.commandDeadline,
+                   self.processor.sectionDeadline or math.inf)
+
+    def checkTimers(self, now):
+        if self.terminating:
+            if now >= self.killDeadline:
+                self.kill(signal.SIGKILL)
+                self.killDeadline = math.inf
+            return
+        if now >= self.deadline:
+            msg = "! {wvtool}: Alarm timed out!  No test output for {timeout:g} seconds.  FAILED"
+            timeout = self.processor.inactivityTimeout or self.timeout
+        elif now >= self.commandDeadline:
+            msg = "! {wvtool}: Command timed out!  It did not finish within {timeout:g} seconds.  FAILED"
+            timeout = self.command_timeout
+        elif now >= (self.processor.sectionDeadline or math.inf):
+            msg = "! {wvtool}: Section timed out!  It did not finish within {timeout:g} seconds.  FAILED"
+            timeout = self.processor.sectionTimeout
+        else:
+            return
+        self.processor.processLine(msg.format(wvtool=sys.argv[0], timeout=timeout))
+        self.terminate()
+
+    def terminate(self):
+        self.kill(signal.SIGTERM)
+        self.terminating = True
+        self.killDeadline = time.monotonic() + self.kill_grace
+
+    def finish(self):
+        "Wait for the command to exit and report its exit code."
+        self.input.flush()
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.exitCode = self.proc.returncode
+
+        if self.proc.returncode != 0:
+            if self.proc.returncode > 0:
+                msg = "{wvtool}: Program '{cmd}' returned non-zero exit code {ec}"
+            else:
+                msg = "{wvtool}: Program '{cmd}' terminated by signal {sig}"
+
+            text = msg.format(wvtool=sys.argv[0], cmd=self.cmd,
+                              ec=self.proc.returncode, sig=-self.proc.returncode)
+            self.processor.append(WvCheckLine(text, 'FAILED'))
+
+        # Finish the last section here rather than when the next
+        # command starts to get its correct duration.
+        self.processor.finish()
+        self.duration = time.monotonic() - self.startTime
+
+    def succeeded(self):
+        "Return True if the finished command did not fail in any way."
+        return (self.proc.returncode == 0 and not self.terminating and
+                self.processor.testFailedCount == self.firstFailed)
+
+class WvCachedChild:
+    """Replays the output of a command stored in WvResultCache instead
+    of running it."""
+
+    def __init__(self, command, processor, path, max_line_length=None, **kwargs):
+        self.cmd = command if isinstance(command, str) else ' '.join(command)
+        self.processor = processor
+        input = WvInputDecoder(processor, max_line_length)
+        processor.setImplicitTestTitle(WvTestingLine("Preamble of "+self.cmd, "wvtool"))
+        processor.timestamp = None
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(_read_size)
+                if not data:
+                    break
+                input.feed(data)
+        input.flush()
+        processor.finish()
+        self.exitCode = 0
+        self.duration = None
+
+class WvResultCache:
+    """Cache of the output of successfully finished commands. Entries
+    are keyed by a hash of the command line, the working directory, the
+    content of the executable, the content of declared input files and the values of
+    selected environment variables. The least recently used entries are
+    removed when the size of the cache exceeds max_size bytes."""
+
+    def __init__(self, directory, max_size, inputs=(), env=()):
+        self.directory = directory
+        self.max_size = max_size
+        self.inputs = inputs
+        self.env = env
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _hashFile(h, filename):
+        try:
+            with open(filename, 'rb') as f:
+                while True:
+                    data = f.read(_read_size)
+                    if not data:
+                        break
+                    h.update(data)
+        except OSError as e:
+            h.update(str(e.errno).encode())
+
+    def key(self, command):
+        h = hashlib.sha256()
+        argv = [command] if isinstance(command, str) else list(command)
+        # The same command line in another directory (e.g. make in
+        # another checkout) runs different tests
+        h.update(json.dumps([argv, os.getcwd()]).encode())
+        executable = shutil.which(argv[0]) if argv else None
+        if executable:
+            self._hashFile(h, executable)
+        for fn in self.inputs:
+            h.update(b'\0' + os.fsencode(fn) + b'\0')
+            self._hashFile(h, fn)
+        for var in self.env:
+            h.update(json.dumps([var, os.environ.get(var)]).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.out')
+
+    def lookup(self, key):
+        "Return the file with the cached output or None."
+        path = self._path(key)
+        try:
+            os.utime(path)      # Mark as recently used
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def newEntry(self):
+        "Return a file to record the output of a command to."
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', delete=False)
+
+    def store(self, key, entry, success):
+        entry.close()
+        if success:
+            os.replace(entry.name, self._path(key))
+            self._evict()
         else:
-            msg = "{wvtool}: Program '{cmd}' terminated by signal {sig}"
+            os.unlink(entry.name)
+
+    def _evict(self):
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.name.endswith('.out'):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.unlink(path)
+            total -= size
+
+    def report(self):
+        print("{wvtool}: Result cache: {hits} hit{plh}, {misses} miss{plm}"
+              .format(wvtool=sys.argv[0], hits=self.hits, misses=self.misses,
+                      plh='' if self.hits == 1 else 's',
+                      plm='' if self.misses == 1 else 'es'), file=sys.stderr)
+
+class WvTimings:
+    """History of durations of commands from previous runs. It is
+    stored in a JSON file and used to schedule the longest commands
+    first."""
+
+    # Number of remembered durations of each command
+    keep = 10
+    # Maximum number of remembered commands, the least recently run
+    # ones are forgotten
+    max_entries = 10000
+
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        try:
+            with open(filename) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        self.data.setdefault('commands', {})
+        # Durations of sections were recorded by older versions, but
+        # never used
+        self.data.pop('sections', None)
+
+    def estimate(self, cmd):
+        "Return the expected duration of the command or None if unknown."
+        if not isinstance(cmd, str):
+            cmd = ' '.join(cmd)
+        durations = self.data['commands'].get(cmd)
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+    def estimates(self, commands):
+        """Return the list of expected durations of commands. Unknown
+        commands are assumed to take the median time of the known ones.
+        If no command is known, all of them are estimated as 0."""
+        estimates = [self.estimate(c) for c in commands]
+        known = sorted(e for e in estimates if e is not None)
+        default = known[len(known) // 2] if known else 0
+        return [default if e is None else e for e in estimates]
+
+    def schedule(self, commands, jobs):
+        """Return the order, in which the commands should be started to
+        finish all of them as soon as possible, and the predicted
+        makespan. Longest commands go first. Without the duration of any
+        of the commands, they are started in the given order and the
+        makespan is None."""
+        if all(self.estimate(c) is None for c in commands):
+            return (range(len(commands)), None)
+        estimates = self.estimates(commands)
+        order = sorted(range(len(commands)), key=lambda i: -estimates[i])
+        workers = [0] * min(jobs, len(commands))
+        for i in order:
+            w = workers.index(min(workers))
+            workers[w] += estimates[i]
+        return (order, max(workers, default=0))
+
+    def record(self, child: WvChild):
+        table = self.data['commands']
+        # Reinsert the command, so that the table is ordered by the last run
+        table[child.cmd] = (table.pop(child.cmd, []) + [round(child.duration, 3)])[-self.keep:]
+
+    def save(self):
+        if self.readonly:
+            return
+        table = self.data['commands']
+        for key in list(itertools.islice(table, max(len(table) - self.max_entries, 0))):
+            del table[key]
+        # Write atomically, so that concurrent wvtool processes do not
+        # corrupt the file.
+        dirname = os.path.dirname(self.filename) or '.'
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=dirname, delete=False) as f:
+                json.dump(self.data, f)
+            os.replace(f.name, self.filename)
+        except OSError as e:
+            print("{wvtool}: Cannot save timings: {err}".format(wvtool=sys.argv[0], err=e),
+                  file=sys.stderr)
+
+class WvCheckpoint:
+    """Checkpoint of incremental processing of a growing log file
+    (format --checkpoint) - the offset up to which the file was
+    processed and the state of the processor at that offset.
+
+    The checkpoint is valid only for the same file (device and inode)
+    with the same content before the offset, which is verified by
+    comparing the last bytes before the offset. The state is pickled,
+    so the checkpoint must not be writable by untrusted users.
+
+    Lines of the current section spilled to disk (WvSectionBuffer) are
+    kept in FILE.N.spill next to the checkpoint FILE, where N is the
+    number of the section, and the checkpoint refers to them."""
+
+    version = 2
+    tail_size = 4096
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = None
+        self.spillName = None
+
+    def _identify(self, file, offset):
+        st = os.fstat(file.fileno())
+        start = max(offset - self.tail_size, 0)
+        return (st.st_dev, st.st_ino, os.pread(file.fileno(), offset - start, start))
+
+    def load(self, file, processor):
+        """Restore the state of processor from the checkpoint of file and
+        return the offset, from which the processing should continue.
+        Return 0 if there is no valid checkpoint."""
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError as e:
+            if e.filename != self.filename:
+                print("{}: {}, processing {} from the beginning"
+                      .format(sys.argv[0], e, file.name), file=sys.stderr)
+            return 0
+        if (data.get('version') != self.version or
+            data['verbosity'] != processor.verbosity or
+            data['identity'] != self._identify(file, data['offset'])):
+            print("{}: {} does not match {}, processing it from the beginning"
+                  .format(sys.argv[0], self.filename, file.name), file=sys.stderr)
+            return 0
+        processor.restore(data['state'])
+        return data['offset']
+
+    def take(self, file, processor, offset):
+        """Take a snapshot of the state of processor after processing file
+        up to offset. It is written to the checkpoint file by save()."""
+        self.spillName = '{}.{}.spill'.format(self.filename, processor.testCount)
+        processor.lines.moveSpill(self.spillName)
+        if processor.lines.spill is None:
+            self.spillName = None
+        self.data = pickle.dumps({
+            'version': self.version,
+            'verbosity': processor.verbosity,
+            'offset': offset,
+            'identity': self._identify(file, offset),
+            'state': processor.checkpoint(),
+        })
+
+    def save(self):
+        if self.data is None:
+            return
+        # Write atomically, so that the checkpoint is not corrupted if
+        # we are killed.
+        dirname = os.path.dirname(self.filename) or '.'
+        with tempfile.NamedTemporaryFile('wb', dir=dirname, delete=False) as f:
+            f.write(self.data)
+        os.replace(f.name, self.filename)
+        # Remove spilled lines of finished sections
+        prefix = os.path.basename(self.filename) + '.'
+        for fn in os.listdir(dirname):
+            path = os.path.join(dirname, fn)
+            if fn.startswith(prefix) and re.fullmatch(r'\d+\.spill', fn[len(prefix):]) and \
+               not (self.spillName and os.path.samefile(path, self.spillName)):
+                os.unlink(path)
+
+class WvPerf:
+    """Results of PERF checks (WvPerfLine) aggregated per section and
+    compared with a baseline from a previous run.
+
+    Repeated samples of a metric in a section are aggregated to their
+    median. The baseline (and the saved results) is a JSON object
+    mapping section ids to metrics:
+
+      {"t/perf.c  Copying": {"memcpy": {"value": 1.25, "units": "ms"}}}
+
+    The id of a section is its name, followed by " #N" for the N-th
+    section of the same name (N >= 2). Forked processors could not
+    number sections in the order of commands or files, so PERF results
+    cannot be used with -j.
+
+    Metrics with units per something (e.g. "MB/s") should be as high as
+    possible, other ones (e.g. times) as low as possible. This can be
+    overridden by "higher_is_better" in the baseline. A metric with a
+    zero baseline regresses by any change in the wrong direction."""
+
+    def __init__(self, baseline=None, tolerance=5.0, filename=None):
+        self.baseline = baseline or {}
+        self.tolerance = tolerance
+        self.filename = filename
+        self.results = {}
+        # Number of finished sections of every name
+        self.occurrences = {}
+
+    @classmethod
+    def load(cls, filename, tolerance=5.0, save=None):
+        baseline = None
+        if filename:
+            try:
+                with open(filename) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                sys.exit("{}: Cannot load performance baseline: {}".format(filename, e))
+        return cls(baseline, tolerance, save)
+
+    def fork(self):
+        return WvPerf(self.baseline, self.tolerance)
+
+    def merge(self, forked):
+        self.results.update(forked.results)
+
+    def sectionId(self, section):
+        "Return the unique id of a newly finished section of the given name."
+        n = self.occurrences[section] = self.occurrences.get(section, 0) + 1
+        return section if n == 1 else '{} #{}'.format(section, n)
+
+    def finishSection(self, section, samples):
+        """Record the aggregated samples (name -> (values, units)) of the
+        section and return the descriptions of regressions."""
+        section = self.sectionId(section)
+        if not samples:
+            return []
+        metrics = self.results[section] = {}
+        baseline = self.baseline.get(section, {})
+        regressions = []
+        for (name, (values, units)) in samples.items():
+            values = sorted(values)
+            n = len(values)
+            value = (values[(n - 1) // 2] + values[n // 2]) / 2
+            metrics[name] = {'value': value, 'units': units}
+            base = baseline.get(name)
+            if not base:
+                continue
+            higher = base.get('higher_is_better', '/' in (units or ''))
+            unit = ' ' + units if units else ''
+            if base['value'] == 0:
+                # The tolerance is relative, so any change is too much
+                if (-value if higher else value) > 0:
+                    regressions.append("PERF regression of {}: {:g}{}, baseline 0{}"
+                                       .format(name, value, unit, unit))
+                continue
+            change = (value - base['value']) / abs(base['value']) * 100
+            if (-change if higher else change) > self.tolerance:
+                regressions.append("PERF regression of {}: {:g}{}, baseline {:g}{} ({:+.1f}%, tolerance {:g}%)"
+                                   .format(name, value, unit, base['value'], unit,
+                                           change, self.tolerance))
+        return regressions
+
+    def save(self):
+        if not self.filename:
+            return
+        dirname = os.path.dirname(self.filename) or '.'
+        with tempfile.NamedTemporaryFile('w', dir=dirname, delete=False) as f:
+            json.dump(self.results, f, indent=1, sort_keys=True)
+        os.replace(f.name, self.filename)
+
+class WvSupervisor:
+    """Event loop supervising any number of concurrently running
+    children. Output of all children and their timers are handled in
+    a single select() call."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.children = []
+        # Set by the signal handler - no new children should be started
+        self.interrupted = False
+
+        signal.signal(signal.SIGINT, self.killAll)
+        signal.signal(signal.SIGTERM, self.killAll)
+
+    def killAll(self, sig = None, frame = None):
+        self.interrupted = True
+        for child in self.children:
+            child.kill(sig)
+
+    def add(self, child: WvChild):
+        self.children.append(child)
+        self.selector.register(child, selectors.EVENT_READ)
+
+    def wait(self, max_wait=math.inf):
+        """Wait for output or timers of running children and handle them,
+        but at most max_wait seconds. Return the list of finished
+        children."""
+        finished = []
+        deadline = min([c.nextDeadline() for c in self.children] +
+                       [time.monotonic() + max_wait])
+        timeout = max(deadline - time.monotonic(), 0) if deadline < math.inf else None
+        for (key, events) in self.selector.select(timeout):
+            child = key.fileobj
+            if not child.read():
+                self.selector.unregister(child)
+                self.children.remove(child)
+                child.finish()
+                finished.append(child)
+        now = time.monotonic()
+        for child in self.children:
+            child.checkTimers(now)
+        return finished
+
+    def close(self):
+        self.selector.close()
+
+def _shard(commands, index, count, timings=None):
+    """Return the commands belonging to the index-th (from 1) of count
+    shards. The partitioning is deterministic - all shards must get the
+    same commands and the same timings. With timings, the expected
+    durations of shards are balanced, otherwise the numbers of
+    commands."""
+    estimates = timings.estimates(commands) if timings else [0] * len(commands)
+    load = [(0, 0, i) for i in range(count)] # (duration, commands, shard)
+    mine = []
+    for i in sorted(range(len(commands)), key=lambda i: (-estimates[i], i)):
+        (duration, n, shard) = heapq.heappop(load)
+        heapq.heappush(load, (duration + estimates[i], n + 1, shard))
+        if shard == index - 1:
+            mine.append(i)
+    return [commands[i] for i in sorted(mine)]
+
+def _run(commands, processor, jobs=1, timings=None, cache=None, **kwargs):
+    """Run commands, at most jobs at a time. When running more commands
+    concurrently, each command is processed by its own forked processor
+    and the results are merged in the order of commands, so the output
+    is the same as if the commands run one after another. Commands are
+    started in the order given by timings (WvTimings) if available.
+    Output of successful commands is stored in cache (WvResultCache)
+    and replayed instead of running the command when they are run
+    again. kwargs are passed to WvChild."""
+    supervisor = WvSupervisor()
+    children = {}               # WvChild -> index of its command
+    keys = {}                   # WvChild -> (cache key, recorded output)
+    finished = {}               # Index of command -> finished WvChild
+    started = merged = 0
+    startTime = time.monotonic()
+
+    if timings and jobs > 1:
+        (order, makespan) = timings.schedule(commands, jobs)
+    else:
+        order = range(len(commands))
 
-        text = msg.format(wvtool=sys.argv[0], cmd=cmd,
-                          ec=proc.returncode, sig=-proc.returncode)
-        processor.append(WvCheckLine(text, 'FAILED'))
+    processor.show_progress = True
+    # Progress is redrawn even when the commands print nothing
+    progress = processor.verbosity < processor.Verbosity.VERBOSE
+    if progress and jobs > 1:
+        def rows():
+            rows = []
+            for child in sorted(children, key=children.get):
+                test = child.processor.currentTest
+                rows.append('  ' + (test.asWvCheckLine(None).text if test else child.cmd))
+            return rows
+        term.set_progress_rows(rows)
+
+    def merge(child):
+        if jobs > 1:
+            if processor.show_progress:
+                term.clear_progress_msg()
+            processor.merge(child.processor)
+        if processor.history:
+            processor.history.addCommand(child)
+        if processor.events:
+            processor.events.exit(child)
+
+    while merged < len(commands):
+        while len(children) < jobs and started < len(commands) and not supervisor.interrupted:
+            i = order[started]
+            started += 1
+            proc = processor.fork() if jobs > 1 else processor
+            if cache:
+                key = cache.key(commands[i])
+                path = cache.lookup(key)
+                if path:
+                    finished[i] = WvCachedChild(commands[i], proc, path, **kwargs)
+                    continue
+                record = cache.newEntry()
+            else:
+                record = None
+            child = WvChild(commands[i], proc, record=record, **kwargs)
+            if record:
+                keys[child] = (key, record)
+            children[child] = i
+            supervisor.add(child)
+
+        for child in supervisor.wait(term.redraw_interval if progress else math.inf) \
+            if children else []:
+            finished[children.pop(child)] = child
+            if timings:
+                timings.record(child)
+            if child in keys:
+                (key, record) = keys.pop(child)
+                cache.store(key, record, child.succeeded())
+
+        while merged in finished:
+            merge(finished.pop(merged))
+            merged += 1
+        if supervisor.interrupted and not children:
+            break
+        if jobs > 1 and processor.show_progress and merged < len(commands):
+            term.set_progress_msg("wvtool: {} of {} commands finished".format(
+                merged + len(finished), len(commands)))
+        elif progress:
+            term.update_progress_msg()
+    supervisor.close()
+    if progress:
+        term.set_progress_rows(None)
+        term.clear_progress_msg()
+    if supervisor.interrupted and merged < len(commands):
+        # Commands after one that was not started
+        for i in sorted(finished):
+            merge(finished.pop(i))
+            merged += 1
+        processor.setImplicitTestTitle(WvTestingLine("Interrupted run", "wvtool"))
+        processor.append(WvCheckLine(
+            "{wvtool}: Interrupted, {n} of {total} commands were not run".format(
+                wvtool=sys.argv[0], n=len(commands) - merged, total=len(commands)), 'FAILED'))
+
+    if cache:
+        cache.report()
+    if timings:
+        timings.save()
+        if jobs > 1 and makespan is not None:
+            print("{wvtool}: Predicted makespan {predicted:.1f} s, actual {actual:.1f} s"
+                  .format(wvtool=sys.argv[0], predicted=makespan,
+                          actual=time.monotonic() - startTime), file=sys.stderr)
+
+def _childOptions(args):
+    return dict(timeout=args.timeout, max_line_length=args.max_line_length,
+                command_timeout=args.command_timeout, kill_grace=args.kill_grace)
+
+def _timings(args):
+    "Return WvTimings of the file given by --timings, if any."
+    return WvTimings(args.timings) if args.timings and not args.no_timings else None
+
+def _cache(args):
+    if not args.cache:
+        return None
+    return WvResultCache(args.cache, args.cache_size * 1024 * 1024,
+                         inputs=args.cache_input, env=args.cache_env)
 
 def do_run(args, processor):
-    _run(args.command, processor, timeout=args.timeout)
+    _run([args.command], processor, timings=_timings(args), cache=_cache(args),
+         **_childOptions(args))
 
 def do_runall(args, processor):
-    for cmd in args.commands:
-        _run(cmd, processor)
+    jobs = args.jobs or os.cpu_count()
+    if processor.perf and jobs > 1 and len(args.commands) > 1:
+        # Sections of the same name would be numbered in the order they
+        # finish rather than in the order of commands (see WvPerf)
+        parser.error('--perf-baseline and --perf-save cannot be combined with -j')
+    timings = _timings(args)
+    commands = args.commands
+    if args.shard:
+        commands = _shard(commands, *args.shard, timings=timings)
+        # Shards must see the same timings to get the same partitioning
+        if timings:
+            timings.readonly = True
+    _run(commands, processor, jobs=jobs,
+         timings=timings, cache=_cache(args), **_childOptions(args))
+
+def do_merge(args, processor):
+    """Merge JUnit XML files and log directories of shards. The files
+    are copied line by line, so they are never loaded to memory as a
+    whole. This relies on the layout of XML files written by wvtool:
+    every <testsuite> element starts on a new line."""
+    if args.shard_logdir and len(args.shard_logdir) != len(args.junit):
+        parser.error('the number of --shard-logdir must match the number of JUnit files')
+    if args.shard_log_archive and len(args.shard_log_archive) != len(args.junit):
+        parser.error('the number of --shard-log-archive must match the number of JUnit files')
+
+    re_testsuite = re.compile(r'<testsuite tests="\d+" errors="\d+" failures="(\d+)"')
+
+    def testsuites(f):
+        "Yield the lines of all testsuites in the file and count them."
+        inside = False
+        for line in f:
+            if not inside:
+                inside = line.startswith('<testsuites>')
+                continue
+            if line.startswith('</testsuites>'):
+                break
+            match = re_testsuite.match(line)
+            if match:
+                processor.testCount += 1
+                processor.testFailedCount += int(match.group(1)) > 0
+            yield line
+
+    for fn in args.junit:
+        with open(fn, encoding='utf-8') as f:
+            lines = testsuites(f)
+            if processor.junit_xml:
+                processor.junitWriter.writeRaw(lines)
+            else:
+                for line in lines:
+                    pass
+
+    if processor.logdir:
+        num = 0
+        for logdir in args.shard_logdir:
+            names = [fn for fn in os.listdir(logdir) if re.match(r'\d+-', fn)]
+            for fn in sorted(names, key=lambda fn: int(fn.split('-', 1)[0])):
+                num += 1
+                shutil.copyfile(os.path.join(logdir, fn),
+                                os.path.join(processor.logdir,
+                                             "%04d-%s" % (num, fn.split('-', 1)[1])))
+
+    if processor.logArchive:
+        for fn in args.shard_log_archive:
+            processor.logArchive.merge(WvLogArchive.load(fn))
+
+def do_logs(args):
+    """List, print or export sections of a --log-archive. Only the
+    index and the selected sections are read."""
+    archive = WvLogArchive.load(args.archive)
+    entries = archive.entries
+    if args.sections:
+        selected = []
+        for section in args.sections:
+            if section.isdigit():
+                if not 1 <= int(section) <= len(entries):
+                    sys.exit("No section {} in {}".format(section, args.archive))
+                selected.append(entries[int(section) - 1])
+            else:
+                selected.extend(e for e in entries if fnmatch.fnmatchcase(e['name'], section))
+        entries = selected
+    if args.failed:
+        entries = [e for e in entries if e['result'] != 'ok']
+
+    if args.export:
+        if not os.path.isdir(args.export):
+            os.mkdir(args.export)
+        for e in entries:
+            with open(os.path.join(args.export, "%04d-%s" % (e['id'], e['name'])), 'wb') as f:
+                f.write(archive.read(e))
+    elif args.sections:
+        for e in entries:
+            sys.stdout.buffer.write(archive.read(e))
+    else:
+        for e in entries:
+            print("%04d %-6s %s" % (e['id'], e['result'], e['name']))
+    archive.close()
+
+def do_history(args):
+    "Query the results stored by --history."
+    if not os.path.exists(args.db):
+        sys.exit("{}: No such file".format(args.db))
+    history = WvHistory.open(args.db, readonly=True)
+    timestamp = lambda t: datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M')
+    if args.query == 'runs':
+        for (run, started, tests, failures, duration, argv) in history.lastRuns(args.count):
+            print("{:6} {} {:>5} tests {:>4} failures {:>8.1f} s  {}".format(
+                run, timestamp(started), tests or 0, failures or 0, duration or 0, argv))
+    elif args.query == 'failing':
+        for (name, run, started, count) in history.failingSince(args.section):
+            print("{} failing since run {} ({}), {} run{}".format(
+                name, run, timestamp(started), count, '' if count == 1 else 's'))
+    elif args.query == 'flaky':
+        for (name, flips, runs) in history.flakiest(args.runs, args.count):
+            print("{:>4} changes in {:>4} runs  {}".format(flips, runs, name))
+    elif args.query == 'durations':
+        for (name, run, started, duration, failed) in history.durations(args.section, args.count):
+            print("{:6} {} {:>10.3f} s {:<6} {}".format(
+                run, timestamp(started), duration, 'FAILED' if failed else 'ok', name))
+    history.db.close()
+
+def _processFile(file, processor):
+    """Process the output of a test (text or binary protocol) read from
+    a binary file. Data are processed as soon as they are available,
+    so that piped output is shown immediately."""
+    input = WvInputDecoder(processor)
+    while True:
+        data = file.read1(_read_size)
+        if not data:
+            break
+        input.feed(data)
+    input.flush()
+
+def _scanFile(file, processor, start=0, end=None):
+    """Process a regular file with the text protocol like _processFile.
+    The file is memory-mapped and while the processor does not need
+    plain lines, only the lines containing the literal text of protocol
+    lines are extracted from it with bulk byte searches; everything
+    between them is skipped without looking at individual lines. This
+    is much faster for logs with long runs of plain output. Where
+    protocol lines are frequent, their processing dominates and the
+    file is processed in chunks of lines as by _processFile. Other
+    files are passed to _processFile.
+
+    Only the part of the file between the start and end offsets
+    (which should be at line boundaries) is processed."""
+    try:
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Not a regular file or an empty one
+        return _processFile(file, processor)
+    with mm:
+        if mm[:len(WvFrameDecoder.magic)] == WvFrameDecoder.magic:
+            return _processFile(file, processor)
+        mayBeProtocol = processor.classifier.mayBeProtocol
+        find = mm.find
+        rfind = mm.rfind
+        size = len(mm) if end is None else end
+        (check, testing, tag) = WvLineClassifier.literals
+        # Positions of the next occurrences of the literals and of
+        # '\r' at or after pos (size if there is none, -1 before the
+        # first search). find() returns -1 if the needle is not found,
+        # which is mapped to size by the modulo.
+        nextCheck = nextTesting = nextTag = nextCR = -1
+        pos = start
+        # When there are many protocol lines, searching for each of
+        # them costs more than splitting the whole chunk to lines.
+        # Protocol lines found since the window position are counted
+        # to switch to that (dense).
+        dense = False
+        window = pos
+        found = 0
+        while pos < size:
+            if dense or processor.needsPlainLines():
+                # Process whole lines up to the first newline after
+                # _read_size bytes, as _processFile would do.
+                eol = find(b'\n', pos + _read_size, size)
+                eol = size if eol < 0 else eol + 1
+                lines = mm[pos:eol].splitlines()
+                if processor.needsPlainLines():
+                    processor.processLines(lines)
+                else:
+                    lines = processor.classifier.protocolLines(lines)
+                    processor.processProtocolLines(lines)
+                    dense = len(lines) >= _dense_lines
+                    window = eol
+                    found = 0
+                pos = eol
+                continue
+            if nextCheck < pos:
+                nextCheck = find(check, pos, size) % (size + 1)
+            if nextTesting < pos:
+                nextTesting = find(testing, pos, size) % (size + 1)
+            if nextTag < pos:
+                nextTag = find(tag, pos, size) % (size + 1)
+            i = min(nextCheck, nextTesting, nextTag)
+            if i == size:
+                break
+            bol = max(rfind(b'\n', pos, i), rfind(b'\r', pos, i), pos - 1) + 1
+            eol = find(b'\n', i, size) % (size + 1)
+            if nextCR < i:
+                nextCR = find(b'\r', i, size) % (size + 1)
+            eol = min(eol, nextCR)
+            line = mm[bol:eol]
+            if mayBeProtocol(line):
+                processor.processLine(line)
+                found += 1
+                if found >= _dense_lines:
+                    dense = pos - window < _read_size
+                    window = pos
+                    found = 0
+            pos = eol + 1
+
+def do_decode(args):
+    "Convert binary protocol to text (text protocol is copied)."
+    class Writer:
+        # Used instead of WvTestProcessor by WvInputDecoder
+        def needsPlainLines(self):
+            return True
+        def processLines(self, lines):
+            sys.stdout.buffer.writelines(line + b'\n' for line in lines)
+        def appendLines(self, lines):
+            sys.stdout.buffer.writelines(line.raw + b'\n' for line in lines)
+
+    for fn in args.infiles or ['-']:
+        if fn == '-':
+            _processFile(sys.stdin.buffer, Writer())
+        else:
+            with open(fn, 'rb') as f:
+                _processFile(f, Writer())
+        sys.stdout.flush()
+
+def _formatFile(processor, fn):
+    # The last section of the previous file ends with it
+    processor.finish()
+    processor.setImplicitTestTitle(WvTestingLine("Preamble", fn))
+    processor.timestamp = None
+    with open(fn, 'rb') as f:
+        _scanFile(f, processor)
+
+def _formatForked(fn):
+    "Process a file in a worker process of format -j."
+    processor = _formatProcessor.fork()
+    _formatFile(processor, fn)
+    processor.finish()
+    return processor
+
+def _lastLineEnd(file, start, size):
+    "Return the offset after the last newline between start and size."
+    if size <= start:
+        return start
+    with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as mm:
+        return mm.rfind(b'\n', start) + 1 or start
+
+def _formatIncremental(args, processor):
+    """Process only the part of the file added since the last run and/or
+    follow the file as it grows. Only complete lines are checkpointed.
+    With a checkpoint, the last section stays open and the incomplete
+    last line is left for the next run."""
+    fn = args.infiles[0]
+    checkpoint = WvCheckpoint(args.checkpoint) if args.checkpoint else None
+    stop = []
+    if args.follow:
+        signal.signal(signal.SIGINT, lambda sig, frame: stop.append(sig))
+        signal.signal(signal.SIGTERM, lambda sig, frame: stop.append(sig))
+    with open(fn, 'rb') as f:
+        if os.pread(f.fileno(), len(WvFrameDecoder.magic), 0) == WvFrameDecoder.magic:
+            sys.exit("{}: Binary protocol cannot be processed incrementally".format(fn))
+        offset = checkpoint.load(f, processor) if checkpoint else 0
+        if offset == 0:
+            processor.setImplicitTestTitle(WvTestingLine("Preamble", fn))
+        while True:
+            size = os.fstat(f.fileno()).st_size
+            if size < offset:
+                print("{}: {} was truncated".format(sys.argv[0], fn), file=sys.stderr)
+                break
+            end = _lastLineEnd(f, offset, size)
+            if end > offset:
+                _scanFile(f, processor, offset, end)
+                offset = end
+                if checkpoint:
+                    checkpoint.take(f, processor, offset)
+                    if args.follow:
+                        checkpoint.save()
+            if not args.follow or stop:
+                break
+            while not stop and os.fstat(f.fileno()).st_size == size:
+                time.sleep(_follow_interval)
+        if checkpoint:
+            # The open section and the incomplete last line are
+            # processed by the next run
+            checkpoint.save()
+            processor.suspend()
+        else:
+            size = os.fstat(f.fileno()).st_size
+            if offset < size:
+                _scanFile(f, processor, offset, size)
 
 def do_format(args, processor):
+    global _formatProcessor
     files = args.infiles
-    if len(files) == 0:
+    jobs = min(args.jobs or os.cpu_count(), len(files))
+    if args.checkpoint or args.follow:
+        if len(files) != 1 or jobs > 1:
+            parser.error('--checkpoint and --follow need exactly one file and no -j')
+        if processor.junit_xml or processor.logdir or processor.logArchive or \
+           processor.history or processor.events:
+            parser.error('--checkpoint and --follow cannot be combined with --junit-xml, '
+                         '--logdir, --log-archive, --history or --events')
+        _formatIncremental(args, processor)
+    elif processor.perf and jobs > 1:
+        # Files processed in other processes could not number sections
+        # of the same name consistently (see WvPerf)
+        parser.error('--perf-baseline and --perf-save cannot be combined with -j')
+    elif len(files) == 0:
         processor.setImplicitTestTitle(WvTestingLine("Preamble", "stdin"))
-        for line in io.TextIOWrapper(sys.stdin.buffer, errors='replace'):
-            processor.processLine(line)
+        _processFile(sys.stdin.buffer, processor)
+    elif jobs > 1:
+        # Every file is processed by a forked processor in a worker
+        # process and the results are merged in the order of files.
+        _formatProcessor = processor
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for forked in pool.imap(_formatForked, files):
+                processor.merge(forked)
     else:
-        for fn in args.infiles:
-            processor.setImplicitTestTitle(WvTestingLine("Preamble", fn))
-            for line in open(fn, errors='replace'):
-                processor.processLine(line)
+        for fn in files:
+            _formatFile(processor, fn)
 
 def do_wrap(args, processor):
     pass
 
+def _jobs(value):
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = -1
+    if jobs < 0:
+        raise argparse.ArgumentTypeError("'{}' is not a non-negative number".format(value))
+    return jobs
+
+def _shardSpec(spec):
+    match = re.match(r'(\d+)/(\d+)$', spec)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError("'{}' is not I/N with 1 <= I <= N".format(spec))
+    return (int(match.group(1)), int(match.group(2)))
+
 parser = argparse.ArgumentParser(description='Versatile wvtest tool')
 
 
@@ -526,13 +2647,67 @@ parser.add_argument('-w', '--width', type=int,
                     help='Override terminal width or COLUMNS environment wariable.')
 parser.add_argument('--timeout', type=int, default=100, metavar='SEC',
                     help='Timeout in seconds for any test output (default %(default)s)')
+parser.add_argument('--command-timeout', type=float, metavar='SEC',
+                    help='Maximum run time of each command in seconds (default unlimited)')
+parser.add_argument('--kill-grace', type=float, default=5, metavar='SEC',
+                    help='''Time between sending SIGTERM and SIGKILL to a timed out
+                    command (default %(default)s)''')
+parser.add_argument('--timings', metavar='FILE',
+                    help='''File with durations of commands from previous runs.
+                    It is used to start the longest commands first with runall -j
+                    and updated by run and runall. Without this option, commands
+                    are started in the given order and no durations are stored.''')
+parser.add_argument('--no-timings', action='store_true',
+                    help='Do not use or update the file given by --timings')
+parser.add_argument('--cache', metavar='DIR',
+                    help='''Store the output of successful commands in DIR and replay it
+                    instead of running the same command again''')
+parser.add_argument('--cache-size', type=int, default=1024, metavar='MB',
+                    help='Maximum size of the cache (default %(default)s)')
+parser.add_argument('--cache-input', action='append', default=[], metavar='FILE',
+                    help='''File that affects the result of commands (in addition to their
+                    executables). Can be given multiple times.''')
+parser.add_argument('--cache-env', action='append', default=[], metavar='VAR',
+                    help='''Environment variable that affects the result of commands.
+                    Can be given multiple times.''')
+parser.add_argument('--history', metavar='DB',
+                    help='''Record commands, sections and checks of this run to SQLite
+                    database DB. See the history sub-command.''')
+parser.add_argument('--max-line-length', type=int, default=1024*1024, metavar='BYTES',
+                    help='''Split longer lines of supervised commands (default %(default)s)''')
 parser.add_argument('--junit-xml', type=argparse.FileType('w'), metavar='FILE',
                     help='''Convert output to JUnit compatible XML file''')
+parser.add_argument('--events', type=argparse.FileType('w'), metavar='FILE',
+                    help='''Write sections, checks, tags and exits of commands to FILE as
+                    they are processed (one JSON object per line)''')
 parser.add_argument('--junit-prefix', metavar='STR',
                     help='''Prefix to prepend to generated class names (useful when a test is
                     run multiple times in different environments)''')
-parser.add_argument('--logdir', metavar='DIR',
-                    help='''Store test logs in the given directory''')
+logs_group = parser.add_mutually_exclusive_group()
+logs_group.add_argument('--logdir', metavar='DIR',
+                        help='''Store test logs in the given directory''')
+logs_group.add_argument('--log-archive', metavar='FILE',
+                        help='''Store test logs in a single FILE (compressed if the name ends
+                        with .gz) indexed by FILE.idx. See the logs sub-command.''')
+parser.add_argument('--perf-baseline', metavar='FILE',
+                    help='''Compare the results of PERF checks (their median in each
+                    section) with the baseline in FILE. Regressions are
+                    reported as failed checks. Repeated sections of the same
+                    name are told apart by their order. Cannot be combined
+                    with -j.''')
+parser.add_argument('--perf-tolerance', type=float, default=5, metavar='P',
+                    help='''Maximum allowed regression of PERF results in percent
+                    (default %(default)s)''')
+parser.add_argument('--perf-save', metavar='FILE',
+                    help='''Save the results of PERF checks to FILE for use with
+                    --perf-baseline''')
+parser.add_argument('--durations', type=int, default=0, metavar='N',
+                    help='''At the end, print the N slowest sections and checks, the
+                    histogram of section durations and the total time spent in
+                    sections''')
+parser.add_argument('--max-buffered-lines', type=int, default=100000, metavar='N',
+                    help='''Maximum number of lines of a "Testing" section kept in memory
+                    (default %(default)s). Other lines are temporarily stored on disk.''')
 parser.add_argument('--color', action='store_true', default=None,
                     help='Force color output')
 parser.add_argument('--no-color', action='store_false', dest='color',
@@ -548,33 +2723,124 @@ parser_run.set_defaults(func=do_run)
 
 parser_runall = subparsers.add_parser('runall', help='Run multiple scripts/binaries mentioned on command line')
 parser_runall.set_defaults(func=do_runall)
+parser_runall.add_argument('-j', '--jobs', type=_jobs, default=1, metavar='N',
+                           help='''Run up to N commands concurrently (0 means the number of
+                           CPUs). The output is the same as when running them one after
+                           another.''')
+parser_runall.add_argument('--shard', type=_shardSpec, metavar='I/N',
+                           help='''Run only the I-th of N deterministic parts of the commands
+                           (I from 1). Parts have the same number of commands unless
+                           --timings FILE is given, in which case they are balanced by
+                           the durations in FILE, so all shards must use the same
+                           FILE. Sharded runs do not update the timings file.
+                           Results of shards can be combined with the merge
+                           sub-command.''')
 parser_runall.add_argument('commands', nargs='+', help='Scripts/binaries to run')
 
+parser_merge = subparsers.add_parser('merge', help='''Merge JUnit XML files (and log directories
+                                     or archives) of sharded runs into a single report,
+                                     which is written according to --junit-xml, --logdir
+                                     and --log-archive''')
+parser_merge.set_defaults(func=do_merge)
+parser_merge.add_argument('--shard-logdir', action='append', default=[], metavar='DIR',
+                          help='''Log directory of a shard. Give one for each JUnit file in
+                          the same order.''')
+parser_merge.add_argument('--shard-log-archive', action='append', default=[], metavar='FILE',
+                          help='''Log archive of a shard. Give one for each JUnit file in
+                          the same order.''')
+parser_merge.add_argument('junit', nargs='+', metavar='XML',
+                          help='JUnit XML files of shards (--junit-xml)')
+
 parser_format = subparsers.add_parser('format', help='Reformat/highlight/summarize WvTest protocol output')
 parser_format.set_defaults(func=do_format)
+parser_format.add_argument('-j', '--jobs', type=_jobs, default=1, metavar='N',
+                           help='''Process up to N files concurrently in separate processes (0
+                           means the number of CPUs). The output is the same as when
+                           processing them one after another.''')
+parser_format.add_argument('--checkpoint', metavar='FILE',
+                           help='''Process the (single) file incrementally: continue from the
+                           state saved in FILE by the previous run and save the state
+                           after processing. Only sections finished since the previous
+                           run are printed, followed by the totals of all sections
+                           finished so far. The last section of the file (and its
+                           incomplete last line) is left for the next run, because
+                           more output may be appended to it. If the file was replaced
+                           or truncated, it is processed from the beginning.''')
+parser_format.add_argument('--follow', action='store_true',
+                           help='''Keep processing the (single) file as it grows, until
+                           interrupted. With --checkpoint, the state is saved after
+                           processing every new part of the file.''')
 parser_format.add_argument('infiles', nargs='*', help='Files with wvtest output')
 
+parser_logs = subparsers.add_parser('logs', help='''List, print or export logs of sections
+                                    stored by --log-archive''')
+parser_logs.set_defaults(func=do_logs, standalone=True)
+parser_logs.add_argument('--failed', action='store_true',
+                         help='Select only failed sections')
+parser_logs.add_argument('--export', metavar='DIR',
+                         help='''Write the selected (default all) sections to DIR as separate
+                         files, as with --logdir''')
+parser_logs.add_argument('archive', metavar='FILE', help='Log archive')
+parser_logs.add_argument('sections', nargs='*', metavar='SECTION',
+                         help='''Section number or a shell pattern matching the log name.
+                         Without --export, logs of the selected sections are printed.
+                         Without sections, all sections are listed.''')
+
+parser_history = subparsers.add_parser('history', help='''Query results of previous runs
+                                       recorded by --history''')
+parser_history.set_defaults(func=do_history, standalone=True)
+parser_history.add_argument('-n', '--count', type=int, default=20, metavar='N',
+                            help='Show at most N rows (default %(default)s)')
+parser_history.add_argument('--runs', type=int, default=30, metavar='N',
+                            help='Number of last runs considered by flaky (default %(default)s)')
+parser_history.add_argument('db', metavar='DB', help='History database')
+parser_history.add_argument('query', choices=['runs', 'failing', 'flaky', 'durations'],
+                            help='''Last runs, sections failing in their last run and since
+                            when, sections whose result changes most often, or durations of
+                            sections in the last runs''')
+parser_history.add_argument('section', nargs='?', default='*', metavar='SECTION',
+                            help='''Shell pattern of section names ("where  what") for
+                            failing and durations (default all)''')
+
+parser_decode = subparsers.add_parser('decode', help='''Convert binary WvTest protocol (e.g. from
+                                      WVTEST_BINARY=1 python/wvtest.py) to text''')
+parser_decode.set_defaults(func=do_decode, standalone=True)
+parser_decode.add_argument('infiles', nargs='*', help='Files with wvtest output (default stdin)')
+
 # parser_wrap = subparsers.add_parser('wrap')
 # parser_wrap.set_defaults(func=do_wrap)
 
-args = parser.parse_args()
-term = Term(args.width)
-if args.color is None and not term.output or \
-   args.color is False:
-    term.clear_colors()
-
-if not 'func' in args:
-    parser.print_help()
-    sys.exit(1)
-
-processor = WvTestProcessor(
-    args.verbosity,
-    junit_xml = args.junit_xml,
-    junit_prefix = args.junit_prefix,
-    logdir=args.logdir)
-args.func(args, processor)
-processor.done()
-sys.exit(0 if processor.is_success() else 1)
+if __name__ == '__main__':
+    args = parser.parse_args()
+    term = Term(args.width)
+    if args.color is None and not term.output or \
+       args.color is False:
+        term.clear_colors()
+
+    if not 'func' in args:
+        parser.print_help()
+        sys.exit(1)
+
+    if 'standalone' in args:
+        # Sub-commands that do not process wvtest output
+        args.func(args)
+        sys.exit(0)
+
+    processor = WvTestProcessor(
+        args.verbosity,
+        junit_xml = args.junit_xml,
+        junit_prefix = args.junit_prefix,
+        logdir=args.logdir,
+        max_buffered_lines=args.max_buffered_lines,
+        log_archive=WvLogArchive.create(args.log_archive) if args.log_archive else None,
+        history=WvHistory.open(args.history) if args.history else None,
+        events=WvEvents(args.events) if args.events else None,
+        durations=args.durations,
+        perf=WvPerf.load(args.perf_baseline, args.perf_tolerance, args.perf_save)
+             if args.perf_baseline or args.perf_save else None)
+    args.func(args, processor)
+    processor.done()
+    sys.exit(0 if processor.is_success() else 1)
 
 # Local Variables:
 # compile-command: "make wvtool"